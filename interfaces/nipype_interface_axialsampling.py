@@ -4,8 +4,10 @@ import numpy as np
 import nilearn.image
 import warnings
 from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, File, traits
+from scripts.qsmxt_io import load_nii, save_nii
+from scripts.qsmxt_dtypes import FLOAT_DTYPES, get_float_dtype, load_float, float_nii
 
-def resample_to_axial(mag_nii, pha_nii, mask_nii=None):
+def resample_to_axial(mag_nii, pha_nii, mask_nii=None, float_dtype=None):
     # calculate base affine
     voxel_size = np.array(mag_nii.header.get_zooms())
     resolution = np.array(mag_nii.header.get_data_shape())
@@ -16,12 +18,12 @@ def resample_to_axial(mag_nii, pha_nii, mask_nii=None):
     base_affine[:3,3] = origin * -np.sign(np.diag(mag_nii.affine)[:3])
 
     # compute real and imaginary components from magnitude and phase
-    pha = pha_nii.get_fdata()
-    mag = mag_nii.get_fdata()
+    pha = load_float(pha_nii, float_dtype)
+    mag = load_float(mag_nii, float_dtype)
     real = mag * np.cos(pha)
     imag = mag * np.sin(pha)
     cplx_header = mag_nii.header.copy()
-    cplx_header.set_data_dtype(np.float32)
+    cplx_header.set_data_dtype(get_float_dtype(float_dtype))
     real_nii = nib.Nifti1Image(real, affine=pha_nii.affine, header=cplx_header)
     imag_nii = nib.Nifti1Image(imag, affine=pha_nii.affine, header=cplx_header)
 
@@ -33,72 +35,68 @@ def resample_to_axial(mag_nii, pha_nii, mask_nii=None):
         mask_rot_nii = nilearn.image.resample_img(mask_nii, target_affine=base_affine, target_shape=None, interpolation='nearest') if mask_nii else None
 
     # convert real and imaginary to magnitude and phase
-    real_rot = real_rot_nii.get_fdata()
-    imag_rot = imag_rot_nii.get_fdata()
+    real_rot = load_float(real_rot_nii, float_dtype)
+    imag_rot = load_float(imag_rot_nii, float_dtype)
     mag_rot = np.array(np.round(np.hypot(real_rot, imag_rot), 0), dtype=mag_nii.header.get_data_dtype())
-    pha_rot = np.array(np.arctan2(imag_rot, real_rot), dtype=np.float16)
+    pha_rot = np.arctan2(imag_rot, real_rot)
 
     # create nifti objects
     mag_rot_nii = nib.Nifti1Image(mag_rot, affine=real_rot_nii.affine, header=mag_nii.header)
-    pha_rot_nii = nib.Nifti1Image(pha_rot, affine=real_rot_nii.affine, header=pha_nii.header)
+    pha_rot_nii = float_nii(pha_rot, pha_nii, affine=real_rot_nii.affine, float_dtype=float_dtype)
 
     return mag_rot_nii, pha_rot_nii, mask_rot_nii
 
-def resample_files(mag_file, pha_file, mask_file=None, obliquity_threshold=None):
+def requires_resampling(affine, obliquity_threshold=None):
+    obliquity = np.rad2deg(nib.affines.obliquity(affine))
+    obliquity_norm = np.linalg.norm(obliquity)
+    return not (obliquity_threshold and obliquity_norm < obliquity_threshold)
+
+def resample_files(mag_file, pha_file, mask_file=None, obliquity_threshold=None, float_dtype=None):
     # load data
     #print(f"Loading mag={os.path.split(mag_file)[1]}...")
-    mag_nii = nib.load(mag_file)
+    mag_nii = load_nii(mag_file)
     #print(f"Loading pha={os.path.split(pha_file)[1]}...")
-    pha_nii = nib.load(pha_file)
+    pha_nii = load_nii(pha_file)
     #if mask_file:
     #    print(f"Loading mask={os.path.split(mask_file)[1]}...")
-    mask_nii = nib.load(mask_file) if mask_file else None        
+    mask_nii = load_nii(mask_file) if mask_file else None        
 
     # check obliquity
-    obliquity = np.rad2deg(nib.affines.obliquity(mag_nii.affine))
-    obliquity_norm = np.linalg.norm(obliquity)
-    if obliquity_threshold and obliquity_norm < obliquity_threshold:
-        #print(f"Obliquity = {obliquity}; norm = {obliquity_norm} < {obliquity_threshold}; no resampling needed.")
+    if not requires_resampling(mag_nii.affine, obliquity_threshold):
         return mag_file, pha_file, mask_file
-    #print(f"Obliquity = {obliquity}; norm = {obliquity_norm} >= {obliquity_threshold}; resampling will commence.")
 
     # resample
-    mag_rot_nii, pha_rot_nii, mask_rot_nii = resample_to_axial(mag_nii, pha_nii, mask_nii)
+    mag_rot_nii, pha_rot_nii, mask_rot_nii = resample_to_axial(mag_nii, pha_nii, mask_nii, float_dtype)
     
     # save results
     mag_fname = os.path.split(mag_file)[1].split('.')[0]
     pha_fname = os.path.split(pha_file)[1].split('.')[0]
-    mag_extension = ".".join(mag_file.split('.')[1:])
-    pha_extension = ".".join(pha_file.split('.')[1:])
-    mag_resampled_fname = os.path.abspath(f"{mag_fname}_resampled.{mag_extension}")
-    pha_resampled_fname = os.path.abspath(f"{pha_fname}_resampled.{pha_extension}")
+    mag_resampled_fname = os.path.abspath(f"{mag_fname}_resampled.nii")
+    pha_resampled_fname = os.path.abspath(f"{pha_fname}_resampled.nii")
     #print(f"Saving mag={mag_resampled_fname}")
-    nib.save(mag_rot_nii, mag_resampled_fname)
+    mag_resampled_fname = save_nii(mag_rot_nii, mag_resampled_fname)
     #print(f"Saving pha={pha_resampled_fname}")
-    nib.save(pha_rot_nii, pha_resampled_fname)
+    pha_resampled_fname = save_nii(pha_rot_nii, pha_resampled_fname)
     
     mask_resampled_fname = "placeholder"
     if mask_rot_nii:
         mask_fname = os.path.split(mask_file)[1].split('.')[0]
-        mask_extension = '.'.join(mask_file.split('.')[1:])
-        mask_resampled_fname = os.path.abspath(f"{mask_fname}_resampled.{mask_extension}")
+        mask_resampled_fname = os.path.abspath(f"{mask_fname}_resampled.nii")
         #print(f"Saving mask={mask_resampled_fname}")
-        nib.save(mask_rot_nii, mask_resampled_fname)
+        mask_resampled_fname = save_nii(mask_rot_nii, mask_resampled_fname)
 
     return mag_resampled_fname, pha_resampled_fname, mask_resampled_fname
 
 
 def resample_like(in_file, in_like, interpolation='continuous'):
-    in_nii = nib.load(in_file)
-    in_like_nii = nib.load(in_like)
+    in_nii = load_nii(in_file)
+    in_like_nii = load_nii(in_like)
     if np.array_equal(in_nii.affine, in_like_nii.affine):
         return in_file
     in_nii_resampled = nilearn.image.resample_img(in_nii, target_affine=in_like_nii.affine, target_shape=np.array(in_like_nii.header.get_data_shape()), interpolation=interpolation)
     in_fname = os.path.split(in_file)[1].split('.')[0]
-    in_extension = ".".join(in_file.split('.')[1:])
-    in_resampled_fname = os.path.abspath(f"{in_fname}_resampled.{in_extension}")
-    nib.save(in_nii_resampled, in_resampled_fname)
-    return in_resampled_fname
+    in_resampled_fname = os.path.abspath(f"{in_fname}_resampled.nii")
+    return save_nii(in_nii_resampled, in_resampled_fname)
 
 
 class AxialSamplingInputSpec(BaseInterfaceInputSpec):
@@ -106,6 +104,7 @@ class AxialSamplingInputSpec(BaseInterfaceInputSpec):
     phase = File(mandatory=True, exists=True)
     mask = File(mandatory=False, exists=True)
     obliquity_threshold = traits.Float(mandatory=False)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
 
 
 class AxialSamplingOutputSpec(TraitedSpec):
@@ -123,7 +122,8 @@ class AxialSamplingInterface(SimpleInterface):
             mag_file=self.inputs.magnitude,
             pha_file=self.inputs.phase,
             mask_file=self.inputs.mask,
-            obliquity_threshold=self.inputs.obliquity_threshold
+            obliquity_threshold=self.inputs.obliquity_threshold,
+            float_dtype=self.inputs.float_dtype
         )
         self._results['magnitude'] = magnitude
         self._results['phase'] = phase
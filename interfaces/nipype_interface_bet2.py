@@ -11,14 +11,14 @@ class Bet2InputSpec(CommandLineInputSpec):
     out_file = File(
         argstr="%s",
         name_source=['in_file'],
-        name_template='%s_bet.nii.gz',
+        name_template='%s_bet.nii',
         position=1,
         exists=False
     )
     mask = File(
         argstr="-m %s",
         name_source=['in_file'],
-        name_template='%s_bet-mask.nii.gz',
+        name_template='%s_bet-mask.nii',
         position=2,
         exists=False
     )
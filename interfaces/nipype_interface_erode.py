@@ -6,22 +6,20 @@ def erosion(in_file, num_erosions=1):
     if num_erosions == 0: return in_file
 
     import os
-    import nibabel as nib
-    from scipy.ndimage import binary_erosion
+    from scripts.mask_morphology import erode
+    from scripts.qsmxt_io import load_nii, save_nii
+    from scripts.qsmxt_dtypes import load_mask, mask_nii
     
     # load data
-    nii = nib.load(in_file)
-    data = nii.get_fdata()
+    nii = load_nii(in_file)
+    data = load_mask(nii)
 
     # erosions
-    for i in range(num_erosions):
-        data = binary_erosion(data).astype(int)
+    data = erode(data, num_erosions)
 
     # write to file
     out_file = f"{os.path.abspath(os.path.split(in_file)[1].split('.')[0])}_ero.nii"
-    nib.save(nib.Nifti1Image(dataobj=data, header=nii.header, affine=nii.affine), out_file)
-
-    return out_file
+    return save_nii(mask_nii(data, nii), out_file)
 
 
 class ErosionInputSpec(BaseInterfaceInputSpec):
@@ -5,7 +5,7 @@ import os
 ## Laplacian wrapper
 class LaplacianInputSpec(CommandLineInputSpec):
     phase = File(position=0, mandatory=True, exists=True, argstr='%s')
-    phase_unwrapped = File(position=1, name_source=['phase'], name_template='%s_laplacian-unwrapped.nii.gz', argstr="%s")
+    phase_unwrapped = File(position=1, name_source=['phase'], name_template='%s_laplacian-unwrapped.nii', argstr="%s")
 
 class LaplacianOutputSpec(TraitedSpec):
     phase_unwrapped = File()
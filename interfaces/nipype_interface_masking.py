@@ -3,145 +3,146 @@
 import os
 import nibabel as nib
 import numpy as np
-from scipy.stats import norm
-from scipy.ndimage import binary_fill_holes, binary_dilation, binary_erosion, gaussian_filter, binary_opening, convolve
+from concurrent.futures import ThreadPoolExecutor
 from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, File, traits, InputMultiPath, OutputMultiPath
-from skimage import filters
-
-# === HELPER FUNCTIONS ===
-
-def _histogram(image_histogram, normalize):
-    bin_edges = np.histogram_bin_edges(image_histogram, bins='fd')
-    hist, _ = np.histogram(image_histogram, bins=bin_edges)
-    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.
-    std = np.std(image_histogram)
-    mean = np.mean(image_histogram)
-    if normalize:
-        hist = hist / np.sum(hist)
-    return hist, bin_centers, mean, std
-
-def _gaussian_threshold(image_histogram):
-    hist, bin, mu, std = _histogram(image_histogram, True)
-    normal_distribution = norm.pdf(bin, mu, std)
-    difference = [normal_distribution[i] - hist[i] if hist[i]<normal_distribution[i] else 0 for i in range(len(hist)) ]
-    maxpoint = max(range(len(difference)), key=difference.__getitem__)
-    #threshold_percent = bin[maxpoint]/np.amax(image_histogram)*100
-    return bin[maxpoint] #threshold_percent
-
-def _clean_histogram(image_histogram):
-    p_lower = np.percentile(image_histogram, 0.05) 
-    p_upper = np.percentile(image_histogram, 99.5)
-    image_histogram = image_histogram[np.logical_and(image_histogram > p_lower, image_histogram < p_upper)]
-    return image_histogram
+from scripts.qsmxt_io import load_nii, save_nii
+from scripts.qsmxt_dtypes import FLOAT_DTYPES, load_float, load_mask
+from scripts.threshold_estimation import gaussian_threshold, otsu_threshold
+from scripts.mask_morphology import erode, dilate, opening, fill_holes, count_neighbours, smooth
 
-# === THRESHOLD-BASED MASKING FOR TWO-PASS AND SINGLE-PASS QSM ===
-def threshold_masking(in_files, bet_masks=None, user_threshold=None, threshold_algorithm='gaussian', threshold_algorithm_factor=1.0, filling_algorithm='both', num_erosions=0, mask_suffix="_mask", fill_masks=False):
-    # sort input filepaths
-    in_files = sorted(in_files)
-
-    # load data
-    all_niis = [nib.load(in_file) for in_file in in_files]
-    all_float_data = [nii.get_fdata() for nii in all_niis]
-    
-    # calculate gaussian threshold if none given
-    def get_threshold(data):
-        if not user_threshold:
-            image_histogram = np.array(data.flatten())
-            if threshold_algorithm == 'gaussian':
-                threshold = _gaussian_threshold(image_histogram)
-            else:
-                threshold = filters.threshold_otsu(image_histogram)
-            threshold *= threshold_algorithm_factor
-        elif round(user_threshold) == user_threshold: # user-defined absolute threshold
-            threshold = user_threshold
-        else: # user-defined percentage threshold
-            data_range = np.max(np.array(all_float_data)) - np.min(np.array(all_float_data))
-            threshold = np.min(np.array(all_float_data)) + (user_threshold * data_range)
-        return threshold
+# volumes larger than this are subsampled when estimating thresholds
+THRESHOLD_MAX_VOXELS = 2**24
 
-    # do masking
-    thresholds = [get_threshold(data) for data in all_float_data]
-    masks = [np.array(all_float_data[i] > thresholds[i], dtype=int) for i in range(len(all_float_data))]
-    masks = [fill_small_holes(mask) for mask in masks]
+# === THRESHOLD-BASED MASKING FOR TWO-PASS AND SINGLE-PASS QSM ===
+def get_range(nii):
+    # min and max of an image without creating a scaled floating-point copy (uncompressed data is memory-mapped)
+    if nib.is_proxy(nii.dataobj):
+        raw_data = nii.dataobj.get_unscaled()
+        slope, inter = nii.dataobj.slope, nii.dataobj.inter
+    else:
+        raw_data = np.asanyarray(nii.dataobj)
+        slope, inter = 1.0, 0.0
+    return tuple(sorted([float(raw_data.min()) * slope + inter, float(raw_data.max()) * slope + inter]))
+
+def get_threshold(data, user_threshold=None, threshold_algorithm='gaussian', threshold_algorithm_factor=1.0, data_range=None):
+    # calculate gaussian or otsu threshold if none given
+    if not user_threshold:
+        if threshold_algorithm == 'gaussian':
+            threshold = gaussian_threshold(data, max_voxels=THRESHOLD_MAX_VOXELS)
+        else:
+            threshold = otsu_threshold(data, max_voxels=THRESHOLD_MAX_VOXELS)
+        threshold *= threshold_algorithm_factor
+    elif round(user_threshold) == user_threshold: # user-defined absolute threshold
+        threshold = user_threshold
+    else: # user-defined percentage threshold of the range across all echoes
+        threshold = data_range[0] + (user_threshold * (data_range[1] - data_range[0]))
+    return threshold
+
+def mask_echo(data, threshold, bet_mask=None, filling_algorithm='both', num_erosions=0, fill_masks=False, n_threads=1):
+    mask = data > threshold
+    mask = fill_small_holes(mask)
     if fill_masks:
         if filling_algorithm in ['gaussian', 'both']:
-            masks = [fill_holes_smoothing(mask) for mask in masks]
+            mask = fill_holes_smoothing(mask, n_threads=n_threads)
         if filling_algorithm in ['morphological', 'both']:
-            masks = [fill_holes_morphological(mask) for mask in masks]
+            mask = fill_holes_morphological(mask)
         if num_erosions:
-            masks = [np.array(binary_erosion(mask, iterations=num_erosions), dtype=int) for mask in masks]
+            mask = erode(mask, num_erosions)
     else:
         # clean up the mask
-        masks = [binary_opening(mask) for mask in masks]
+        mask = opening(mask)
 
         # erode the mask without expanding holes
         if num_erosions:
-            # use a bet masks to inform this, if available
-            if bet_masks:
-                bet_masks = [nib.load(bet_mask).get_fdata() for bet_mask in bet_masks]
-                masks_filled = [np.array((masks[i] + bet_masks[i]) >= 1, dtype=int) for i in range(len(masks))]
+            # use a bet mask to inform this, if available
+            if bet_mask is not None:
+                mask_filled = mask | bet_mask
             else:
-                masks_filled = [fill_holes_morphological(mask) for mask in masks]
+                mask_filled = fill_holes_morphological(mask)
 
-            # erode the mask without expanding holes
-            masks_filled_ero = [np.array(binary_erosion(mask, iterations=num_erosions), dtype=int) for mask in masks_filled]
-            
-            holes = [np.array((masks_filled_ero[i] - masks[i]) == 1, int) for i in range(len(masks))]
+            # erode the mask without expanding holes, i.e. remove the holes from the eroded filled mask
+            mask_filled_ero = erode(mask_filled, num_erosions)
+            del mask_filled
+            mask &= mask_filled_ero
+    return mask
 
-            masks = [np.array((masks_filled_ero[i] - holes[i]) >= 1, dtype=int) for i in range(len(masks))]
+def threshold_masking(in_files, bet_masks=None, user_threshold=None, threshold_algorithm='gaussian', threshold_algorithm_factor=1.0, filling_algorithm='both', num_erosions=0, mask_suffix="_mask", fill_masks=False, n_threads=1, float_dtype=None):
+    # each echo is loaded, masked and saved in turn, so only the echoes in progress are held in memory
+    # up to n_threads echoes are processed concurrently (scipy and numpy release the GIL); any threads
+    # left over are used to smooth each echo's mask
+    # sort input filepaths
+    in_files = sorted(in_files)
+    all_niis = [load_nii(in_file) for in_file in in_files]
+
+    # percentage thresholds are relative to the range across all echoes, found in a first pass
+    data_range = None
+    if user_threshold and round(user_threshold) != user_threshold:
+        echo_ranges = [get_range(nii) for nii in all_niis]
+        data_range = (min(r[0] for r in echo_ranges), max(r[1] for r in echo_ranges))
 
     # determine filenames
     mask_filenames = [f"{os.path.abspath(os.path.split(in_file)[1].split('.')[0])}{mask_suffix}.nii" for in_file in in_files]
 
-    for i in range(len(masks)):
+    n_workers = max(1, min(n_threads, len(all_niis)))
+    echo_threads = max(1, n_threads // n_workers)
+
+    def mask_and_save(i):
+        nii = all_niis[i]
+
+        # do masking
+        data = load_float(nii, float_dtype)
+        threshold = get_threshold(data, user_threshold, threshold_algorithm, threshold_algorithm_factor, data_range)
+        bet_mask = load_mask(bet_masks[i]) if bet_masks and num_erosions and not fill_masks else None
+        mask = mask_echo(data, threshold, bet_mask, filling_algorithm, num_erosions, fill_masks, echo_threads)
+        del data, bet_mask
+
         # set mask datatype to uint8
-        all_niis[i].header.set_data_dtype(np.uint8)
+        nii.header.set_data_dtype(np.uint8)
 
         # add threshold information to nifti description
-        threshold_description = f"Threshold = {round(thresholds[i], 3)}"
-        description = str(all_niis[i].header['descrip'].astype(str)).strip()
+        threshold_description = f"Threshold = {round(threshold, 3)}"
+        description = str(nii.header['descrip'].astype(str)).strip()
         if description == "":
-            all_niis[i].header['descrip'] = threshold_description
+            nii.header['descrip'] = threshold_description
         else:
-            all_niis[i].header['descrip'] = f"{description}; {threshold_description}"
+            nii.header['descrip'] = f"{description}; {threshold_description}"
         
         # save mask to file
-        nib.save(
+        mask_filenames[i] = save_nii(
             nib.Nifti1Image(
-                dataobj=masks[i],
-                header=all_niis[i].header,
-                affine=all_niis[i].affine
+                dataobj=mask,
+                header=nii.header,
+                affine=nii.affine
             ),
             mask_filenames[i]
         )
+        return threshold
+
+    if n_workers == 1:
+        thresholds = [mask_and_save(i) for i in range(len(all_niis))]
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            thresholds = list(executor.map(mask_and_save, range(len(all_niis))))
 
     return mask_filenames, thresholds
 
 # The smoothing removes background noise and closes small holes
 # A smaller threshold grows the mask
-def fill_holes_smoothing(mask, sigma=[5,5,5], threshold=0.4):
-    smoothed = gaussian_filter(mask * 1.0, sigma, truncate=2.0) # truncate reduces the kernel size: less precise but faster
-    return np.array(smoothed > threshold, dtype=int)
+# Smoothing is done in float32, split across n_threads
+def fill_holes_smoothing(mask, sigma=[5,5,5], threshold=0.4, n_threads=1):
+    smoothed = smooth(mask, sigma, truncate=2.0, n_threads=n_threads) # truncate reduces the kernel size: less precise but faster
+    return smoothed > threshold
 
 # original morphological operation
 def fill_holes_morphological(mask, fill_strength=0):
-    filled_mask = mask.copy()
-    for j in range(fill_strength):
-        filled_mask = binary_dilation(filled_mask).astype(int)
-    filled_mask = binary_fill_holes(filled_mask).astype(int)
-    for j in range(fill_strength):
-        filled_mask = binary_erosion(filled_mask).astype(int)
-    return filled_mask
+    filled_mask = dilate(mask, fill_strength)
+    filled_mask = fill_holes(filled_mask)
+    return erode(filled_mask, fill_strength)
 
 def fill_small_holes(mask):
+    # fill voxels with at most one background voxel among their 26 neighbours
     mask = mask.copy()
-    kernel = np.array([
-        [[1, 1, 1], [1, 1, 1], [1, 1, 1]],
-        [[1, 1, 1], [1, 0, 1], [1, 1, 1]],
-        [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
-    ])
-    weights = convolve(mask, kernel, mode='constant', cval=0.0)
-    mask[weights >= 27 - 2] = 1
+    mask[count_neighbours(mask) >= 26 - 1] = True
     return mask
 
 class MaskingInputSpec(BaseInterfaceInputSpec):
@@ -154,6 +155,8 @@ class MaskingInputSpec(BaseInterfaceInputSpec):
     threshold_algorithm_factor = traits.Float(mandatory=False, default_value=1.0)
     filling_algorithm = traits.String(mandatory=False, value='both')
     num_erosions = traits.Int(mandatory=False, default_value=0)
+    num_threads = traits.Int(1, usedefault=True, nohash=True)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
 
 
 class MaskingOutputSpec(TraitedSpec):
@@ -176,6 +179,8 @@ class MaskingInterface(SimpleInterface):
             num_erosions=self.inputs.num_erosions,
             mask_suffix=f"_{self.inputs.mask_suffix}",
             fill_masks=self.inputs.fill_masks,
+            n_threads=self.inputs.num_threads,
+            float_dtype=self.inputs.float_dtype
         )
         self._results['mask'] = mask
         self._results['threshold'] = threshold
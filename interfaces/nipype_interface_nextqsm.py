@@ -5,13 +5,14 @@ import nibabel as nib
 
 from nipype.interfaces.base import traits, SimpleInterface, CommandLine, BaseInterfaceInputSpec, TraitedSpec, File
 from nipype.utils.filemanip import fname_presuffix, split_filename
+from scripts import qsmxt_io
 
 
 ## NeXtQSM wrapper
 class NextqsmInputSpec(BaseInterfaceInputSpec):
     phase = File(mandatory=True, exists=True, argstr="%s", position=0)
     mask = File(mandatory=False, exists=True, argstr="%s", position=1)
-    qsm = File(argstr="%s", name_source=['phase'], name_template='%s_nextqsm.nii.gz', position=2)
+    qsm = File(argstr="%s", name_source=['phase'], name_template='%s_nextqsm.nii', position=2)
     #out_suffix = traits.String("_qsm_recon", desc='Suffix for output files. Will be followed by 000 (reason - see CLI)',
     #                           usedefault=True, argstr="-o %s")
 
@@ -26,18 +27,17 @@ class NextqsmInterface(CommandLine):
 
 ## Normalize input data for NeXtQSM
 def save_nii(data, file_path, nii_like):
-    nib.save(nib.nifti1.Nifti1Image(data, affine=nii_like.affine, header=nii_like.header), file_path)
+    return qsmxt_io.save_nii(nib.nifti1.Nifti1Image(data, affine=nii_like.affine, header=nii_like.header), file_path)
 
 # fieldStrength in [T], TE in [s]
 def normalize(phase, fieldStrength, TE, filename=None):
     centre_freq = 127736254 / 3 * fieldStrength # in [Hz]
-    phase_nii = nib.load(phase)
+    phase_nii = qsmxt_io.load_nii(phase)
     phase = phase_nii.get_fdata()
     normalized = phase / (2 * np.pi * TE * centre_freq) * 1e6
     
     if filename is not None:
-        save_nii(normalized, filename, phase_nii)
-        return filename
+        return save_nii(normalized, filename, phase_nii)
     
     return normalized
     
@@ -60,7 +60,7 @@ class NormalizeInterface(SimpleInterface):
     
     def _run_interface(self, runtime):
         _, fname, _ = split_filename(self.inputs.phase)
-        filename = fname_presuffix(fname=fname + self.inputs.out_suffix, suffix=".nii.gz", newpath=os.getcwd())
+        filename = fname_presuffix(fname=fname + self.inputs.out_suffix, suffix=".nii", newpath=os.getcwd())
         self._results['out_file'] = normalize(self.inputs.phase, self.inputs.fieldStrength, self.inputs.TE, filename)
         return runtime
 
@@ -68,18 +68,15 @@ class NormalizeInterface(SimpleInterface):
 # fieldstrength in [T]
 def normalizeB0(B0_file, fieldStrength, filename=None):
     centre_freq = 127736254 / 3 * fieldStrength # in [Hz]
-    B0_nii = nib.load(B0_file)
+    B0_nii = qsmxt_io.load_nii(B0_file)
     B0 = B0_nii.get_fdata() # in [Hz]
     normalized = B0 / centre_freq * 1e3
     
     if not filename:
         filename = os.path.split(B0_file)[-1]
-        extension = ".".join(filename.split('.')[1:])
-        filename = f"{filename}_normalize.{extension}"
+        filename = f"{filename.split('.')[0]}_normalize.nii"
 
-    save_nii(normalized, filename, B0_nii)
-
-    return filename
+    return save_nii(normalized, filename, B0_nii)
 
 class NormalizeB0InputSpec(BaseInterfaceInputSpec):
     B0_file = File(mandatory=True, exists=True)
@@ -98,6 +95,6 @@ class NormalizeB0Interface(SimpleInterface):
     
     def _run_interface(self, runtime):
         _, fname, _ = split_filename(self.inputs.B0_file)
-        filename = fname_presuffix(fname=fname + self.inputs.out_suffix, suffix=".nii.gz", newpath=os.getcwd())
+        filename = fname_presuffix(fname=fname + self.inputs.out_suffix, suffix=".nii", newpath=os.getcwd())
         self._results['out_file'] = normalizeB0(self.inputs.B0_file, self.inputs.fieldStrength, filename)
         return runtime
@@ -1,29 +1,29 @@
 #!/usr/bin/env python3
 
-from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, InputMultiPath, File
+from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, InputMultiPath, File, traits
+from scripts.qsmxt_dtypes import FLOAT_DTYPES
 
 
-def nonzero_average(in_files, mask_files=None, save_result=True):
+def nonzero_average(in_files, mask_files=None, save_result=True, float_dtype=None):
     import os
-    import nibabel as nib
     import numpy as np
+    from scripts.qsmxt_io import load_nii, save_nii
+    from scripts.qsmxt_dtypes import load_float, load_mask, float_nii
 
     if len(in_files) == 1: return in_files[0]
 
     data = []
     for in_data_file in in_files:
-        in_data_nii = nib.load(in_data_file)
-        in_data = in_data_nii.get_fdata()
+        in_data_nii = load_nii(in_data_file)
+        in_data = load_float(in_data_nii, float_dtype)
         data.append(in_data)
     data = np.array(data)
 
     if mask_files:
         mask = []
         for in_mask_file in mask_files:
-            in_mask_nii = nib.load(in_mask_file)
-            in_data = in_mask_nii.get_fdata()
-            mask.append(in_data)
-        mask = np.array(mask, dtype=int)
+            mask.append(load_mask(in_mask_file))
+        mask = np.array(mask)
         mask *= abs(data) >= 5e-5
     else:
         mask = abs(data) >= 5e-5
@@ -35,8 +35,7 @@ def nonzero_average(in_files, mask_files=None, save_result=True):
 
     if save_result:
         filename = f"{os.path.abspath(os.path.split(in_files[0])[1].split('.')[0])}_average.nii"
-        nib.save(nib.nifti1.Nifti1Image(final, affine=in_data_nii.affine, header=in_data_nii.header), filename)
-        return filename
+        return save_nii(float_nii(final, in_data_nii, float_dtype=float_dtype), filename)
 
     return final
 
@@ -44,6 +43,7 @@ def nonzero_average(in_files, mask_files=None, save_result=True):
 class NonzeroAverageInputSpec(BaseInterfaceInputSpec):
     in_files = InputMultiPath(mandatory=True, exists=True)
     in_masks = InputMultiPath(mandatory=False, exists=True)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
 
 
 class NonzeroAverageOutputSpec(TraitedSpec):
@@ -55,7 +55,7 @@ class NonzeroAverageInterface(SimpleInterface):
     output_spec = NonzeroAverageOutputSpec
 
     def _run_interface(self, runtime):
-        self._results['out_file'] = nonzero_average(self.inputs.in_files, self.inputs.in_masks)
+        self._results['out_file'] = nonzero_average(self.inputs.in_files, self.inputs.in_masks, float_dtype=self.inputs.float_dtype)
         return runtime
 
 
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import nibabel as nib
+
+from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, traits, File
+from scripts.qsmxt_functions import extend_fname
+from scripts.qsmxt_io import load_nii, save_nii
+from scripts.qsmxt_dtypes import FLOAT_DTYPES, load_float, float_nii
+from interfaces.nipype_interface_process_phase import scale_phase
+from interfaces.nipype_interface_axialsampling import resample_to_axial, requires_resampling
+
+def preprocess_files(phase_file, magnitude_file=None, mask_file=None, obliquity_threshold=None, float_dtype=None):
+    # loads each input once, then scales the phase to -pi,+pi, reorients to the closest canonical (RAS)
+    # orientation and, if magnitude is available and the acquisition is oblique, resamples to axial
+    # only the final images are written; inputs that are unchanged are returned as-is
+    phase_nii = load_nii(phase_file)
+    magnitude_nii = load_nii(magnitude_file) if magnitude_file else None
+    mask_nii = load_nii(mask_file) if mask_file else None
+    phase_changed = magnitude_changed = mask_changed = False
+
+    # scale phase data
+    phase_scaled = scale_phase(load_float(phase_nii, float_dtype))
+    if phase_scaled is not None:
+        phase_nii = float_nii(phase_scaled, phase_nii, float_dtype=float_dtype)
+        phase_changed = True
+
+    # reorient to canonical
+    if nib.aff2axcodes(phase_nii.affine) != ('R', 'A', 'S'):
+        phase_nii = nib.as_closest_canonical(phase_nii)
+        phase_changed = True
+        if magnitude_nii:
+            magnitude_nii = nib.as_closest_canonical(magnitude_nii)
+            magnitude_changed = True
+        if mask_nii:
+            mask_nii = nib.as_closest_canonical(mask_nii)
+            mask_changed = True
+
+    # resample to axial
+    if magnitude_nii and requires_resampling(magnitude_nii.affine, obliquity_threshold):
+        magnitude_nii, phase_nii, mask_nii = resample_to_axial(magnitude_nii, phase_nii, mask_nii, float_dtype)
+        phase_changed = magnitude_changed = True
+        mask_changed = mask_nii is not None
+
+    # save results
+    if phase_changed:
+        phase_file = extend_fname(phase_file, "_preprocessed", ext="nii")
+        phase_file = save_nii(phase_nii, phase_file)
+    if magnitude_changed:
+        magnitude_file = extend_fname(magnitude_file, "_preprocessed", ext="nii")
+        magnitude_file = save_nii(magnitude_nii, magnitude_file)
+    if mask_changed:
+        mask_file = extend_fname(mask_file, "_preprocessed", ext="nii")
+        mask_file = save_nii(mask_nii, mask_file)
+
+    return phase_file, magnitude_file, mask_file
+
+
+class PreprocessInputSpec(BaseInterfaceInputSpec):
+    phase = File(mandatory=True, exists=True)
+    magnitude = File(mandatory=False, exists=True)
+    mask = File(mandatory=False, exists=True)
+    obliquity_threshold = traits.Float(mandatory=False)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
+
+
+class PreprocessOutputSpec(TraitedSpec):
+    phase = File(exists=True)
+    magnitude = File(mandatory=False)
+    mask = File(mandatory=False)
+
+
+class PreprocessInterface(SimpleInterface):
+    input_spec = PreprocessInputSpec
+    output_spec = PreprocessOutputSpec
+
+    def _run_interface(self, runtime):
+        phase, magnitude, mask = preprocess_files(
+            phase_file=self.inputs.phase,
+            magnitude_file=self.inputs.magnitude or None,
+            mask_file=self.inputs.mask or None,
+            obliquity_threshold=self.inputs.obliquity_threshold or None,
+            float_dtype=self.inputs.float_dtype
+        )
+        self._results['phase'] = phase
+        if magnitude: self._results['magnitude'] = magnitude
+        if mask: self._results['mask'] = mask
+        return runtime
+
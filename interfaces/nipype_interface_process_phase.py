@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
-import nibabel as nib
 import numpy as np
 
 from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, traits, File
 from scripts.qsmxt_functions import extend_fname
+from scripts.qsmxt_io import load_nii, save_nii
+from scripts.qsmxt_dtypes import FLOAT_DTYPES, load_float, float_nii
 
-def frequency_to_normalized(frequency_path, B0, scale_factor=1, out_path=None):
+def frequency_to_normalized(frequency_path, B0, scale_factor=1, out_path=None, float_dtype=None):
     # use scale_factor=1e6 for microradians (needed for nextqsm)
     # load ΔB (Hz)
-    frequency_nii = nib.load(frequency_path)
-    ΔB = frequency_nii.get_fdata()
+    frequency_nii = load_nii(frequency_path)
+    ΔB = load_float(frequency_nii, float_dtype)
     
     # gyromagnetic ratio in Hz/T
     γ = 42.58*10**6
@@ -18,15 +19,15 @@ def frequency_to_normalized(frequency_path, B0, scale_factor=1, out_path=None):
     Φ_norm = (2*np.pi * ΔB) / (γ * B0) * scale_factor
 
     # save result
-    out_path = out_path or extend_fname(frequency_path, f"_normalized")
-    nib.save(img=nib.Nifti1Image(dataobj=Φ_norm, header=frequency_nii.header, affine=frequency_nii.affine), filename=out_path)
-    return out_path
+    out_path = out_path or extend_fname(frequency_path, f"_normalized", ext="nii")
+    return save_nii(img=float_nii(Φ_norm, frequency_nii, float_dtype=float_dtype), filename=out_path)
 
 
 class FreqToNormalizedInputSpec(BaseInterfaceInputSpec):
     frequency = File(mandatory=True, exists=True)
     B0 = traits.Float(mandatory=True)
     scale_factor = traits.Float(mandatory=False, default_value=1)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
     
 
 class FreqToNormalizedOutputSpec(TraitedSpec):
@@ -41,15 +42,16 @@ class FreqToNormalizedInterface(SimpleInterface):
         self._results['phase_normalized'] = frequency_to_normalized(
             frequency_path=self.inputs.frequency,
             B0=self.inputs.B0,
-            scale_factor=self.inputs.scale_factor
+            scale_factor=self.inputs.scale_factor,
+            float_dtype=self.inputs.float_dtype
         )
         return runtime
 
 
-def frequency_to_phase(frequency_path, TE, wraps=False, out_path=None):
+def frequency_to_phase(frequency_path, TE, wraps=False, out_path=None, float_dtype=None):
     # load ΔB (Hz)
-    frequency_nii = nib.load(frequency_path)
-    ΔB = frequency_nii.get_fdata()
+    frequency_nii = load_nii(frequency_path)
+    ΔB = load_float(frequency_nii, float_dtype)
     
     # phase accumulation at TE (rads)
     Φ_acc = 2*np.pi * ΔB * TE
@@ -58,15 +60,15 @@ def frequency_to_phase(frequency_path, TE, wraps=False, out_path=None):
     if wraps: Φ_acc = (Φ_acc + np.pi) % (2 * np.pi) - np.pi
     
     # save results
-    out_path = out_path or extend_fname(frequency_path, f"_phase-TE{int(TE*1000):0>3}")
-    nib.save(img=nib.Nifti1Image(dataobj=Φ_acc, header=frequency_nii.header, affine=frequency_nii.affine), filename=out_path)
-    return out_path
+    out_path = out_path or extend_fname(frequency_path, f"_phase-TE{int(TE*1000):0>3}", ext="nii")
+    return save_nii(img=float_nii(Φ_acc, frequency_nii, float_dtype=float_dtype), filename=out_path)
 
 
 class FreqToPhaseInputSpec(BaseInterfaceInputSpec):
     frequency = File(mandatory=True, exists=True)
     TE = traits.Float(mandatory=True)
     wraps = traits.Bool(default_value=False)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
     
 
 class FreqToPhaseOutputSpec(TraitedSpec):
@@ -81,18 +83,19 @@ class FreqToPhaseInterface(SimpleInterface):
         self._results['phase'] = frequency_to_phase(
             frequency_path=self.inputs.frequency,
             TE=self.inputs.TE,
-            wraps=self.inputs.wraps
+            wraps=self.inputs.wraps,
+            float_dtype=self.inputs.float_dtype
         )
         return runtime
 
 
-def phase_to_normalized(phase_path, B0, TE, scale_factor=1, out_path=None):
+def phase_to_normalized(phase_path, B0, TE, scale_factor=1, out_path=None, float_dtype=None):
     # use scale_factor=1e6 for microradians (needed for nextqsm)
     # use scale_factor=1e6/(2*np.pi) for ??? (needed for rts, tv, etc.)
 
     # load phase
-    phase_nii = nib.load(phase_path)
-    Φ_acc = phase_nii.get_fdata()
+    phase_nii = load_nii(phase_path)
+    Φ_acc = load_float(phase_nii, float_dtype)
 
     # gyromagnetic ratio in Hz/T
     γ = 42.58*10**6
@@ -101,10 +104,8 @@ def phase_to_normalized(phase_path, B0, TE, scale_factor=1, out_path=None):
     Φ_norm = Φ_acc / (TE * γ * B0) * scale_factor
 
     # save result
-    out_path = out_path or extend_fname(phase_path, f"_normalized")
-    nib.save(img=nib.Nifti1Image(dataobj=Φ_norm, header=phase_nii.header, affine=phase_nii.affine), filename=out_path)
-
-    return out_path
+    out_path = out_path or extend_fname(phase_path, f"_normalized", ext="nii")
+    return save_nii(img=float_nii(Φ_norm, phase_nii, float_dtype=float_dtype), filename=out_path)
 
 
 class PhaseToNormalizedInputSpec(BaseInterfaceInputSpec):
@@ -112,6 +113,7 @@ class PhaseToNormalizedInputSpec(BaseInterfaceInputSpec):
     B0 = traits.Float(mandatory=False, default_value=3)
     TE = traits.Float(mandatory=True)
     scale_factor = traits.Float(mandatory=False, default_value=1)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
     
 
 class PhaseToNormalizedOutputSpec(TraitedSpec):
@@ -127,31 +129,40 @@ class PhaseToNormalizedInterface(SimpleInterface):
             phase_path=self.inputs.phase,
             B0=self.inputs.B0,
             TE=self.inputs.TE,
-            scale_factor=self.inputs.scale_factor
+            scale_factor=self.inputs.scale_factor,
+            float_dtype=self.inputs.float_dtype
         )
         return runtime
 
 
-def scale_to_pi(phase_path, phase_scaled_path=None):
+def scale_phase(Φ_acc_wrapped):
+    # returns None if the phase is already scaled correctly
+    # compared with a tolerance so that the check holds for float32 as well as float64 data
+    if np.isclose(np.min(Φ_acc_wrapped), -3.14, atol=1e-2) and np.isclose(np.max(Φ_acc_wrapped), 3.14, atol=1e-2):
+        return None
+    
+    # scale to -pi,+pi
+    return np.array(np.interp(Φ_acc_wrapped, (Φ_acc_wrapped.min(), Φ_acc_wrapped.max()), (-np.pi, +np.pi)), dtype=Φ_acc_wrapped.dtype)
+
+
+def scale_to_pi(phase_path, phase_scaled_path=None, float_dtype=None):
     # load input phase
-    phase_nii = nib.load(phase_path)
-    Φ_acc_wrapped = phase_nii.get_fdata()
+    phase_nii = load_nii(phase_path)
+    Φ_acc_wrapped = load_float(phase_nii, float_dtype)
     
     # return the original if it is already scaled correctly
-    if (np.round(np.min(Φ_acc_wrapped), 2)*-1) == np.round(np.max(Φ_acc_wrapped), 2) == 3.14:
+    Φ_acc_wrapped_scaled = scale_phase(Φ_acc_wrapped)
+    if Φ_acc_wrapped_scaled is None:
         return phase_path
-    
-    # scale to -pi,+pi
-    Φ_acc_wrapped_scaled = np.array(np.interp(Φ_acc_wrapped, (Φ_acc_wrapped.min(), Φ_acc_wrapped.max()), (-np.pi, +np.pi)), dtype=Φ_acc_wrapped.dtype)
 
     # save result
-    phase_scaled_path = phase_scaled_path or extend_fname(phase_path, "_scaled")
-    nib.save(nib.Nifti1Image(dataobj=Φ_acc_wrapped_scaled, header=phase_nii.header, affine=phase_nii.affine), phase_scaled_path)
-    return phase_scaled_path
+    phase_scaled_path = phase_scaled_path or extend_fname(phase_path, "_scaled", ext="nii")
+    return save_nii(float_nii(Φ_acc_wrapped_scaled, phase_nii, float_dtype=float_dtype), phase_scaled_path)
 
 
 class ScalePhaseInputSpec(BaseInterfaceInputSpec):
     phase = File(mandatory=True, exists=True)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
     
 
 class ScalePhaseOutputSpec(TraitedSpec):
@@ -163,7 +174,7 @@ class ScalePhaseInterface(SimpleInterface):
     output_spec = ScalePhaseOutputSpec
 
     def _run_interface(self, runtime):
-        self._results['phase_scaled'] = scale_to_pi(self.inputs.phase)
+        self._results['phase_scaled'] = scale_to_pi(self.inputs.phase, float_dtype=self.inputs.float_dtype)
         return runtime
 
 
@@ -4,39 +4,53 @@ import os
 from nipype.interfaces.base import  traits, CommandLine, BaseInterfaceInputSpec, TraitedSpec, File, InputMultiPath, OutputMultiPath
 from scripts.qsmxt_functions import extend_fname
 from scripts import qsmxt_functions
+from scripts.qsmxt_io import load_nii, save_nii
+from scripts.qsmxt_dtypes import FLOAT_DTYPES, get_float_dtype, load_float, float_nii
 import nibabel as nib
 import numpy as np
     
-def merge_multi_echo(in_paths, out_path):
-    image4d = np.stack([nib.load(f).get_fdata() for f in in_paths], -1)
-    sample_nii = nib.load(in_paths[0])
-    nib.save(nib.nifti1.Nifti1Image(image4d, affine=sample_nii.affine, header=sample_nii.header), out_path)
+def merge_multi_echo(in_paths, out_path, float_dtype=None):
+    # NIfTI data is stored in Fortran order, so each echo of the 4D image is a contiguous block
+    # that can be written after the header as it is loaded, without holding the stacked image in memory
+    sample_nii = load_nii(in_paths[0])
+    header = sample_nii.header.copy()
+    header.set_data_shape(sample_nii.shape[:3] + (len(in_paths),))
+    header.set_data_dtype(get_float_dtype(float_dtype))
+    header.set_slope_inter(1, 0)
+    header['vox_offset'] = 0
+    with open(out_path, 'wb') as out_file:
+        header.write_to(out_file)
+        out_file.seek(header.get_data_offset())
+        for in_path in in_paths:
+            echo_data = load_float(in_path, float_dtype)
+            out_file.write(echo_data.astype(header.get_data_dtype(), copy=False).tobytes(order='F'))
     return out_path
 
 def split_multi_echo(in_path, out_paths):
-    image4d = nib.load(in_path).get_fdata()
-    sample_nii = nib.load(in_path)
+    # slicing the proxy reads one echo at a time (memory-mapped for uncompressed files)
+    image4d_nii = load_nii(in_path)
 
+    saved_paths = []
     for i, out_path in enumerate(out_paths):
-        echo_data = image4d[..., i]
-        echo_nii = nib.nifti1.Nifti1Image(echo_data, affine=sample_nii.affine, header=sample_nii.header)
-        nib.save(echo_nii, out_path)
+        echo_data = image4d_nii.dataobj[..., i]
+        echo_nii = nib.nifti1.Nifti1Image(echo_data, affine=image4d_nii.affine, header=image4d_nii.header)
+        saved_paths.append(save_nii(echo_nii, out_path))
 
-    return out_paths
+    return saved_paths
 
-def wrap_phase(phase_path):
-    phase_nii = nib.load(phase_path)
-    phase = phase_nii.get_fdata()
+def wrap_phase(phase_path, float_dtype=None):
+    phase_nii = load_nii(phase_path)
+    phase = load_float(phase_nii, float_dtype)
     phase_wrapped = (phase + np.pi) % (2 * np.pi) - np.pi
     phase_wrapped_path = extend_fname(phase_path, "_wrapped", ext="nii")
-    nib.save(img=nib.Nifti1Image(dataobj=phase_wrapped, affine=phase_nii.affine, header=phase_nii.header), filename=phase_wrapped_path)
-    return phase_wrapped_path
+    return save_nii(img=float_nii(phase_wrapped, phase_nii, float_dtype=float_dtype), filename=phase_wrapped_path)
 
 class RomeoB0InputSpec(BaseInterfaceInputSpec):
     # required inputs
     phase = InputMultiPath(mandatory=True, exists=True)
     magnitude = InputMultiPath(mandatory=False, exists=True)
     TE = traits.ListFloat(mandatory=True, argstr="-t '[%s]'")
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
     
     # automatically filled
     combine_phase = File(exists=True, argstr="--phase %s", position=0)
@@ -55,9 +69,9 @@ class RomeoB0Interface(CommandLine):
     _cmd = os.path.join(qsmxt_functions.get_qsmxt_dir(), "scripts", "romeo_unwrapping.jl -B --no-rescale --phase-offset-correction")
 
     def _run_interface(self, runtime):
-        self.inputs.combine_phase = merge_multi_echo(self.inputs.phase, os.path.join(os.getcwd(), "multi-echo-phase.nii"))
+        self.inputs.combine_phase = merge_multi_echo(self.inputs.phase, os.path.join(os.getcwd(), "multi-echo-phase.nii"), self.inputs.float_dtype)
         if self.inputs.combine_mag:
-            self.inputs.combine_mag = merge_multi_echo(self.inputs.magnitude, os.path.join(os.getcwd(), "multi-echo-mag.nii"))
+            self.inputs.combine_mag = merge_multi_echo(self.inputs.magnitude, os.path.join(os.getcwd(), "multi-echo-mag.nii"), self.inputs.float_dtype)
         self.inputs.TE = [TE*1000 for TE in self.inputs.TE]
         return super(RomeoB0Interface, self)._run_interface(runtime)
         
@@ -3,17 +3,19 @@ import argparse
 import os
 import nibabel as nib
 import numpy as np
-from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, File
+from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, File, traits
+from scripts.qsmxt_io import load_nii, save_nii
+from scripts.qsmxt_dtypes import FLOAT_DTYPES, load_float, load_mask, float_nii
 
 
-def twopass_nifti(in_file1, in_file2, mask=None, save_result=True, out_name=None):
-    in1_nii = nib.load(in_file1)
-    in2_nii = nib.load(in_file2)
-    if mask: in_mask_nii = nib.load(mask)
+def twopass_nifti(in_file1, in_file2, mask=None, save_result=True, out_name=None, float_dtype=None):
+    in1_nii = load_nii(in_file1)
+    in2_nii = load_nii(in_file2)
+    if mask: in_mask_nii = load_nii(mask)
 
-    in1_data = in1_nii.get_fdata()
-    in2_data = in2_nii.get_fdata()
-    if mask: mask_data = in_mask_nii.get_fdata()
+    in1_data = load_float(in1_nii, float_dtype)
+    in2_data = load_float(in2_nii, float_dtype)
+    if mask: mask_data = load_mask(in_mask_nii)
 
     if not mask:
         out_data = in1_data + (in2_data * (abs(in1_data) < 5e-05))
@@ -24,8 +26,7 @@ def twopass_nifti(in_file1, in_file2, mask=None, save_result=True, out_name=None
         if not out_name:
             filename = f"{os.path.splitext(os.path.splitext(os.path.split(in_file1)[1])[0])[0]}_twopass.nii"
             out_name = os.path.join(os.path.abspath(os.curdir), filename)
-        nib.save(nib.nifti1.Nifti1Image(out_data, affine=in1_nii.affine, header=in1_nii.header), out_name)
-        return out_name
+        return save_nii(float_nii(out_data, in1_nii, float_dtype=float_dtype), out_name)
 
     return out_data
 
@@ -34,6 +35,7 @@ class TwopassNiftiInputSpec(BaseInterfaceInputSpec):
     in_file1 = File(mandatory=True, exists=True)
     in_file2 = File(mandatory=True, exists=True)
     mask = File(mandatory=False, exists=True)
+    float_dtype = traits.Enum(*FLOAT_DTYPES, usedefault=True)
 
 
 class TwopassNiftiOutputSpec(TraitedSpec):
@@ -45,7 +47,7 @@ class TwopassNiftiInterface(SimpleInterface):
     output_spec = TwopassNiftiOutputSpec
 
     def _run_interface(self, runtime):
-        self._results['out_file'] = twopass_nifti(self.inputs.in_file1, self.inputs.in_file2, self.inputs.mask)
+        self._results['out_file'] = twopass_nifti(self.inputs.in_file1, self.inputs.in_file2, self.inputs.mask, float_dtype=self.inputs.float_dtype)
         return runtime
 
 
@@ -7,11 +7,21 @@
 import argparse
 import os
 import sys
+import shutil
 import pydicom  # pydicom is using the gdcm package for decompression
 import datetime
+import time
+import tarfile
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from scripts.qsmxt_functions import get_qsmxt_version, get_diff
-from scripts.logger import LogLevel, make_logger, show_warning_summary
+from scripts.logger import LogLevel, make_logger, get_logger, show_warning_summary
+from scripts.dicom_index import open_index, get_file_stat, get_cached_headers, update_headers, find_sorted_duplicate, set_out_paths, prune_index
+from scripts.dicom_archive import is_archive, is_tar, is_archive_location, split_archive_location, make_archive_location, list_archive_members, stream_tar_members, open_member, read_member_bytes, close_archives
+
+FICLONE = 0x40049409
+SERIES_COMPLETE_MARKER = ".qsmxt_series_complete"
 
 def empty_dirs(root_dir='.', recursive=True):
     empty_dirs = []
@@ -40,72 +50,320 @@ def clean_text(string):
         string = string.replace(str(symbol), "_") # replace everything with an underscore
     return string.lower()  
 
-def find_dicoms(input_dir, check_all_files):
-    unsortedList = []
-    for root, dirs, files in os.walk(input_dir):
-        for f in files:
-            file_extension = ".".join(f.split('.')[-1:])
-            if file_extension.lower() in ['ima', 'dcm']:
-                unsortedList.append(os.path.join(root, f))
-    if not unsortedList or check_all_files:
-        if not unsortedList:
-            logger.log(LogLevel.WARNING.value, "No .IMA or .dcm files found! Checking all files for valid DICOM headers...")
-        for root, dirs, files in os.walk(input_dir):
-            for f in files:
+# replaced by a configured logger when run as a script; shared with other scripts that import dicomsort()
+logger = get_logger()
+
+# value representations used to recognise explicit VR DICOM files without a preamble
+DICOM_VRS = set([
+    b'AE', b'AS', b'AT', b'CS', b'DA', b'DS', b'DT', b'FD', b'FL', b'IS', b'LO', b'LT', b'OB', b'OD', b'OF', b'OL',
+    b'OV', b'OW', b'PN', b'SH', b'SL', b'SQ', b'SS', b'ST', b'SV', b'TM', b'UC', b'UI', b'UL', b'UN', b'UR', b'US',
+    b'UT', b'UV'
+])
+
+def is_dicom_file(path):
+    # checks the 'DICM' magic after the 128-byte preamble, without parsing the file
+    try:
+        if is_archive_location(path):
+            data = read_member_bytes(path, 132)
+        else:
+            with open(path, 'rb') as f:
+                data = f.read(132)
+    except Exception:
+        return False
+    if len(data) == 132 and data[128:132] == b'DICM':
+        return True
+
+    # fallback for files without a preamble: the first element should be a little endian
+    # file meta (0002,xxxx) or identifying (0008,xxxx) element with a valid VR or a plausible length
+    if len(data) < 8:
+        return False
+    group = int.from_bytes(data[0:2], 'little')
+    if group not in [0x0002, 0x0008]:
+        return False
+    if data[4:6] in DICOM_VRS:
+        return True
+    length = int.from_bytes(data[4:8], 'little')
+    return length % 2 == 0 and length < 1024
+
+def scan_files(input_dir):
+    # recursively lists files using os.scandir, in the same order as os.walk
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(input_dir) as entries:
+            for entry in entries:
                 try:
-                    ds = pydicom.read_file(os.path.join(root, f))
-                    unsortedList.append(os.path.join(root, f))
-                except:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry.path)
+                except OSError:
                     pass
+    except OSError:
+        return files
+    for subdir in subdirs:
+        files.extend(scan_files(subdir))
+    return files
+
+def is_tar_location(dicom_loc):
+    return is_archive_location(dicom_loc) and is_tar(split_archive_location(dicom_loc)[0])
+
+def get_location_stat(dicom_loc):
+    # archive members share the size and modification time of their archive
+    return get_file_stat(split_archive_location(dicom_loc)[0])
+
+def find_dicoms(input_dir, check_all_files, verbose=True, n_threads=1, sniff_cache=None):
+    # zip and tar archives (or an archive given as input_dir) are searched without extracting them;
+    # sniff_cache ({path: (stat, is_dicom)}) can be given to only sniff files that changed since a previous call
+    close_archives()
+    allFiles = []
+    for f in (scan_files(input_dir) if os.path.isdir(input_dir) else [input_dir]):
+        if is_archive(f):
+            allFiles.extend(make_archive_location(f, member) for member in list_archive_members(f))
+        else:
+            allFiles.append(f)
+    unsortedList = [f for f in allFiles if f.split('.')[-1].lower() in ['ima', 'dcm']]
+    if not unsortedList or check_all_files:
+        if not unsortedList and verbose:
+            logger.log(LogLevel.WARNING.value, "No .IMA or .dcm files found! Checking all files for valid DICOM headers...")
+        # sniffing is I/O-bound, so threads are sufficient; tar streams are read in member order
+        candidates = [f for f in allFiles if f.split('.')[-1].lower() not in ['ima', 'dcm']]
+        isDicom = {}
+        if sniff_cache is not None:
+            stats = { f : get_location_stat(f) for f in candidates }
+            isDicom = { f : sniff_cache[f][1] for f in candidates if stats[f] is not None and sniff_cache.get(f, (None,))[0] == stats[f] }
+            candidates = [f for f in candidates if f not in isDicom]
+        threadCandidates = [f for f in candidates if not is_tar_location(f)]
+        with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+            isDicom.update(zip(threadCandidates, executor.map(is_dicom_file, threadCandidates)))
+        tarCandidates = [f for f in candidates if is_tar_location(f)]
+        isDicom.update(zip(tarCandidates, location_map(is_dicom_file, tarCandidates)))
+        if sniff_cache is not None:
+            sniff_cache.update({ f : (stats[f], isDicom[f]) for f in candidates })
+        extensionFiles = set(unsortedList)
+        unsortedList = [f for f in allFiles if f in extensionFiles or isDicom.get(f)]
     return unsortedList
 
-def dicomsort(input_dir, output_dir, use_patient_names, use_session_dates, check_all_files, delete_originals):
+def parallel_map(function, *iterables, n_procs=1):
+    # run function over the iterables using a process pool; results are returned in input order
+    if n_procs <= 1:
+        return list(map(function, *iterables))
+    iterables = [list(iterable) for iterable in iterables]
+    chunksize = max(1, len(iterables[0]) // (n_procs * 16))
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        return list(executor.map(function, *iterables, chunksize=chunksize))
+
+def location_map(function, dicom_locs, *iterables, n_procs=1):
+    # like parallel_map over DICOM locations, except that tar members are processed serially in this process,
+    # in a single streaming pass per archive, because compressed tar archives can only be read sequentially;
+    # files and zip members are processed in parallel
+    dicom_locs = list(dicom_locs)
+    iterables = [list(iterable) for iterable in iterables]
+    is_serial = [is_tar_location(dicom_loc) for dicom_loc in dicom_locs]
+    parallel_idx = [i for i in range(len(dicom_locs)) if not is_serial[i]]
+    serial_idx = [i for i in range(len(dicom_locs)) if is_serial[i]]
+
+    # worker processes must not share archive handles with this process
+    close_archives()
+    results = [None for dicom_loc in dicom_locs]
+    parallel_results = parallel_map(function, [dicom_locs[i] for i in parallel_idx], *[[iterable[i] for i in parallel_idx] for iterable in iterables], n_procs=n_procs)
+    for i, result in zip(parallel_idx, parallel_results):
+        results[i] = result
+    archive_idx = {}
+    for i in serial_idx:
+        archive_path, member_name = split_archive_location(dicom_locs[i])
+        archive_idx.setdefault(archive_path, {}).setdefault(member_name, []).append(i)
+    for archive_path, member_idx in archive_idx.items():
+        try:
+            for member_name in stream_tar_members(archive_path, member_idx.keys()):
+                for i in member_idx[member_name]:
+                    results[i] = function(dicom_locs[i], *[iterable[i] for iterable in iterables])
+        except (OSError, EOFError, tarfile.TarError) as e:
+            logger.log(LogLevel.WARNING.value, f"Failed to read archive {archive_path}! {e}.")
+    close_archives()
+    return results
+
+def read_dataset(dicom_loc, **kwargs):
+    if is_archive_location(dicom_loc):
+        with open_member(dicom_loc) as f:
+            return pydicom.read_file(f, **kwargs)
+    return pydicom.read_file(dicom_loc, **kwargs)
+
+def read_dicom_header(dicom_loc):
+    # read the header only - pixel data is not needed to build the sort plan
+    try:
+        ds = read_dataset(dicom_loc, stop_before_pixels=True)
+    except pydicom.errors.InvalidDicomError:
+        # files without a preamble are only read if they look like DICOM
+        if not is_dicom_file(dicom_loc):
+            return None
+        try:
+            ds = read_dataset(dicom_loc, stop_before_pixels=True, force=True)
+        except:
+            return None
+    except:
+        return None
+
+    # determine whether the pixel data needs decompressing; unknown transfer syntaxes are rewritten as before
+    transfer_syntax = ds.file_meta.get("TransferSyntaxUID", None) if hasattr(ds, 'file_meta') else None
+    try:
+        compressed = transfer_syntax.is_compressed if transfer_syntax else None
+    except ValueError:
+        compressed = None
+
+    # get patient, study, and series information
+    return {
+        'patientName' : clean_text(str(ds.get("PatientName", "NA"))),
+        'patientID' : clean_text(ds.get("PatientID", "NA")),
+        'studyDate' : clean_text(ds.get("StudyDate", "NA")),
+        'studyDescription' : clean_text(ds.get("StudyDescription", "NA")),
+        'protocolName' : clean_text(ds.get("ProtocolName", "NA")),
+        'seriesNumber' : clean_text(str(ds.get("SeriesNumber", "NA"))),
+        'modality' : ds.get("Modality","NA"),
+        'studyInstanceUID' : ds.get("StudyInstanceUID","NA"),
+        'seriesInstanceUID' : ds.get("SeriesInstanceUID","NA"),
+        'instanceNumber' : str(ds.get("InstanceNumber","0")),
+        'sopInstanceUID' : ds.get("SOPInstanceUID","NA"),
+        'compressed' : compressed
+    }
+
+def reflink(src, dst):
+    # copy-on-write clone (Linux FICLONE ioctl); supported by e.g. XFS, Btrfs and some NFS servers
+    import fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+def place_file(src, dst, placement='copy'):
+    # places src at dst without parsing it; falls back to a copy where the filesystem does not support the placement
+    if os.path.lexists(dst):
+        if os.path.samefile(src, dst): return
+        os.remove(dst)
+    if placement == 'move':
+        shutil.move(src, dst)
+        return
+    if placement == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    if placement == 'reflink':
+        try:
+            reflink(src, dst)
+            return
+        except (OSError, ImportError):
+            pass
+    if placement == 'symlink':
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+def sort_dicom(dicom_loc, out_path, compressed=None, placement='copy'):
+    # returns a warning message if anything went wrong, as worker processes cannot use the logger
+
+    # uncompressed archive members are streamed straight to the output
+    if compressed is False and is_archive_location(dicom_loc):
+        try:
+            with open_member(dicom_loc) as src, open(out_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        except Exception as e:
+            return f"Failed to extract {dicom_loc} to {out_path}! {e}."
+        return None
+
+    # uncompressed files are placed as-is without parsing the pixel data
+    if compressed is False:
+        try:
+            place_file(dicom_loc, out_path, placement)
+        except Exception as e:
+            return f"Failed to {placement} {dicom_loc} to {out_path}! {e}."
+        return None
+
+    try:
+        ds = read_dataset(dicom_loc, force=True)
+    except Exception as e:
+        return f"Failed to read file as DICOM: {dicom_loc}. {e}."
+
+    # uncompress files (using the gdcm package)
+    warning = None
+    try:
+        ds.decompress()
+    except Exception as e:
+        warning = f"An exception occurred while decompressing {dicom_loc}! {e}."
+
+    ds.save_as(out_path)
+
+    # the original is consumed when moving
+    if placement == 'move' and not is_archive_location(dicom_loc) and os.path.exists(out_path) and not os.path.samefile(dicom_loc, out_path):
+        os.remove(dicom_loc)
+
+    return warning
+
+def dicomsort(input_dir, output_dir, use_patient_names, use_session_dates, check_all_files, delete_originals, n_procs=1, placement='copy', use_index=True, dicom_locs=None, state=None, prune=True):
+    # sorts the given files (or all DICOMs found in input_dir) and returns the list of (dicom_loc, out_path) placed;
+    # state holds the subject/session numbering so that it can be carried across calls in watch mode;
+    # the 'symlink' placement (used internally by run_1_dicomConvert.py) links to the originals, so they must be kept
+    if placement == 'symlink' and delete_originals:
+        raise ValueError("The 'symlink' placement cannot be used when deleting the original DICOMs!")
     os.makedirs(output_dir, exist_ok=True)
-    logger.log(LogLevel.INFO.value, "Reading file list...")
-    unsortedList = find_dicoms(input_dir, check_all_files)
+    if dicom_locs is None:
+        logger.log(LogLevel.INFO.value, "Reading file list...")
+        unsortedList = find_dicoms(input_dir, check_all_files, n_threads=n_procs)
+    else:
+        unsortedList = list(dicom_locs)
     logger.log(LogLevel.INFO.value, f"{len(unsortedList)} DICOM files found.")
     fail = False
 
-    subjName_dates = []
-    subjName_sessionNums = {}
-
+    state = state if state is not None else {}
+    subjName_dates = state.setdefault('subjName_dates', [])
+    subjName_sessionNums = state.setdefault('subjName_sessionNums', {})
+    sopInstanceUIDs = state.setdefault('sopInstanceUIDs', {})
+
+    # reuse headers from the index for files that are unchanged since the last run
+    stats = [get_location_stat(dicom_loc) for dicom_loc in unsortedList]
+    cached = {}
+    if use_index:
+        index = open_index(os.path.join(output_dir, "dicomsort_index.sqlite"))
+        cached = get_cached_headers(index, unsortedList, stats)
+        logger.log(LogLevel.INFO.value, f"{len(cached)} unchanged DICOM files found in index {os.path.join(output_dir, 'dicomsort_index.sqlite')}.")
+
+    newList = [dicom_loc for dicom_loc in unsortedList if dicom_loc not in cached]
+    logger.log(LogLevel.INFO.value, f"Reading {len(newList)} DICOM headers (excluding pixel data) using {n_procs} processes...")
+    newHeaders = dict(zip(newList, location_map(read_dicom_header, newList, n_procs=n_procs)))
+    if use_index:
+        update_headers(index, newList, [stat for dicom_loc, stat in zip(unsortedList, stats) if dicom_loc not in cached], [newHeaders[dicom_loc] for dicom_loc in newList])
+    headers = [cached[dicom_loc][0] if dicom_loc in cached else newHeaders[dicom_loc] for dicom_loc in unsortedList]
+
+    # assign subjects, sessions and series serially so that numbering follows the file order
     logger.log(LogLevel.INFO.value, f"Sorting DICOMs in {output_dir}...")
-    for dicom_loc in unsortedList:
-        # read the file
-        try:
-            ds = pydicom.read_file(dicom_loc)
-        except:
+    sortedList = []
+    for dicom_loc, header in zip(unsortedList, headers):
+        if header is None:
             logger.log(LogLevel.WARNING.value, f"Failed to read file as DICOM: {dicom_loc}. Skipping...")
             continue
-    
-        # get patient, study, and series information
-        patientName = clean_text(str(ds.get("PatientName", "NA")))
-        patientID = clean_text(ds.get("PatientID", "NA"))
-        studyDate = clean_text(ds.get("StudyDate", "NA"))
-        studyDescription = clean_text(ds.get("StudyDescription", "NA"))
-        protocolName = clean_text(ds.get("ProtocolName", "NA"))
-        seriesNumber = clean_text(str(ds.get("SeriesNumber", "NA")))
-    
+
+        # skip duplicate instances, including those sorted from other files during previous runs
+        if header['sopInstanceUID'] != "NA":
+            if header['sopInstanceUID'] not in sopInstanceUIDs and use_index:
+                duplicate_loc = find_sorted_duplicate(index, header['sopInstanceUID'], dicom_loc)
+                if duplicate_loc: sopInstanceUIDs[header['sopInstanceUID']] = duplicate_loc
+            if sopInstanceUIDs.get(header['sopInstanceUID'], dicom_loc) != dicom_loc:
+                logger.log(LogLevel.WARNING.value, f"Duplicate SOPInstanceUID {header['sopInstanceUID']} in {dicom_loc} (already found in {sopInstanceUIDs[header['sopInstanceUID']]}). Skipping...")
+                continue
+            sopInstanceUIDs[header['sopInstanceUID']] = dicom_loc
+
         # generate new, standardized file name
-        modality = ds.get("Modality","NA")
-        studyInstanceUID = ds.get("StudyInstanceUID","NA")
-        seriesInstanceUID = ds.get("SeriesInstanceUID","NA")
-        instanceNumber = str(ds.get("InstanceNumber","0"))
-        fileName = modality + "." + seriesInstanceUID + "." + instanceNumber + ".dcm"
+        fileName = header['modality'] + "." + header['seriesInstanceUID'] + "." + header['instanceNumber'] + ".dcm"
 
-        subj_name = patientName if use_patient_names else patientID
+        subj_name = header['patientName'] if use_patient_names else header['patientID']
         subj_name = subj_name.replace('-', '').replace('_', '')
-        subj_name = subj_name.replace('-', '').replace('_', '')
-        
-        # uncompress files (using the gdcm package)
-        try:
-            ds.decompress()
-        except Exception as e:
-            logger.log(LogLevel.WARNING.value, f"An exception occurred while decompressing {dicom_loc}! {e}.")
-        
+        studyDate = header['studyDate']
+
         # save files to a 3-tier nested folder structure
         subjFolderName = f"sub-{subj_name}"
-        seriesFolderName = f"{seriesNumber}_{protocolName}"
+        seriesFolderName = f"{header['seriesNumber']}_{header['protocolName']}"
         subjName_date = f"{subj_name}_{studyDate}"
 
         if not any(subj_name in x for x in subjName_dates):
@@ -124,16 +382,122 @@ def dicomsort(input_dir, output_dir, use_patient_names, use_session_dates, check
         if not os.path.exists(os.path.join(output_dir, subjFolderName, sesFolderName, seriesFolderName)):
             logger.log(LogLevel.INFO.value, f"Identified series: {subjFolderName}/{sesFolderName}/{seriesFolderName}")
             os.makedirs(os.path.join(output_dir, subjFolderName, sesFolderName, seriesFolderName), exist_ok=True)
-        
-        ds.save_as(os.path.join(output_dir, subjFolderName, sesFolderName, seriesFolderName, fileName))
 
-        if not os.path.exists(os.path.join(output_dir, subjFolderName, sesFolderName, seriesFolderName, fileName)):
+        sortedList.append((dicom_loc, os.path.join(output_dir, subjFolderName, sesFolderName, seriesFolderName, fileName), header['compressed']))
+
+    # files already placed at the same destination during a previous run need no further work
+    toPlace = [
+        x for x in sortedList
+        if not (x[0] in cached and cached[x[0]][1] == x[1] and os.path.exists(x[1]))
+    ]
+    if len(toPlace) != len(sortedList):
+        logger.log(LogLevel.INFO.value, f"{len(sortedList) - len(toPlace)} DICOMs already sorted during a previous run.")
+
+    # read, decompress and write the files in parallel
+    num_compressed = len([x for x in toPlace if x[2] is not False])
+    logger.log(LogLevel.INFO.value, f"Placing {len(toPlace)} sorted DICOMs ({placement}) using {n_procs} processes ({num_compressed} require decompression)...")
+    warnings = location_map(sort_dicom, [x[0] for x in toPlace], [x[1] for x in toPlace], [x[2] for x in toPlace], [placement for x in toPlace], n_procs=n_procs)
+    for (dicom_loc, out_path, compressed), warning in zip(toPlace, warnings):
+        if warning:
+            logger.log(LogLevel.WARNING.value, warning)
+        if not os.path.exists(out_path):
             fail = True
 
+    # record destinations; sorted files are indexed too so that in-place reruns can reuse them
+    if use_index:
+        placed = [x for x in toPlace if os.path.exists(x[1])]
+        set_out_paths(index, [x[0] for x in placed], [x[1] for x in placed])
+        headersByLoc = dict(zip(unsortedList, headers))
+        update_headers(index, [x[1] for x in placed], [get_file_stat(x[1]) for x in placed], [headersByLoc[x[0]] for x in placed], [x[1] for x in placed])
+
     if not fail and delete_originals:
-        for dicom_loc in unsortedList:
+        # archives are deleted as a whole, so only once every member has been sorted; otherwise they are kept
+        out_paths = set(x[1] for x in sortedList)
+        sorted_locs = set(x[0] for x in sortedList if os.path.exists(x[1]))
+        for dicom_loc in dict.fromkeys(split_archive_location(dicom_loc)[0] for dicom_loc in unsortedList):
+            if not os.path.exists(dicom_loc) or dicom_loc in out_paths:
+                continue
+            if is_archive(dicom_loc):
+                unsorted_members = [member for member in list_archive_members(dicom_loc) if make_archive_location(dicom_loc, member) not in sorted_locs]
+                close_archives()
+                if unsorted_members:
+                    logger.log(LogLevel.WARNING.value, f"Keeping archive {dicom_loc} as {len(unsorted_members)} of its members were not sorted.")
+                    continue
             os.remove(dicom_loc)
 
+    if use_index:
+        if prune:
+            num_pruned = prune_index(index, unsortedList)
+            if num_pruned:
+                logger.log(LogLevel.INFO.value, f"Removed {num_pruned} missing files from the DICOM index.")
+        index.close()
+
+    return [(x[0], x[1]) for x in sortedList if os.path.exists(x[1])]
+
+def write_series_complete(series_dir, num_instances):
+    # marker read by downstream tools to start conversion of a series before the whole batch has arrived
+    with open(os.path.join(series_dir, SERIES_COMPLETE_MARKER), 'w', encoding='utf-8') as f:
+        f.write(f"{num_instances}\n")
+
+def dicomsort_watch(input_dir, output_dir, poll_interval=10, series_quiet_period=60, watch_timeout=None, **kwargs):
+    # polls input_dir and sorts files once their size and modification time are unchanged between two polls;
+    # a series is marked complete once no new instances have arrived for series_quiet_period seconds
+    logger.log(LogLevel.INFO.value, f"Watching {input_dir} for new DICOMs every {poll_interval}s (press Ctrl+C to stop)...")
+    state = {}
+    last_stats = {}
+    sniff_cache = {}
+    sorted_locs = set()
+    series_instances = {}
+    series_last_update = {}
+    last_activity = time.time()
+
+    try:
+        while True:
+            # find files that have not changed since the previous poll; only new or changed files are sniffed
+            stats = {}
+            for dicom_loc in find_dicoms(input_dir, kwargs.get('check_all_files', False), verbose=False, n_threads=kwargs.get('n_procs', 1), sniff_cache=sniff_cache):
+                if dicom_loc not in sorted_locs:
+                    stats[dicom_loc] = get_location_stat(dicom_loc)
+            settled = [dicom_loc for dicom_loc, stat in stats.items() if stat is not None and last_stats.get(dicom_loc) == stat]
+            last_stats = stats
+
+            if settled:
+                placed = dicomsort(input_dir, output_dir, dicom_locs=settled, state=state, prune=False, **kwargs)
+                sorted_locs.update(settled)
+                for dicom_loc, out_path in placed:
+                    series_dir = os.path.dirname(out_path)
+                    sorted_locs.add(out_path)
+                    series_instances.setdefault(series_dir, set()).add(out_path)
+                    series_last_update[series_dir] = time.time()
+                    if os.path.exists(os.path.join(series_dir, SERIES_COMPLETE_MARKER)):
+                        logger.log(LogLevel.WARNING.value, f"New instances arrived for series already marked complete: {series_dir}")
+                        os.remove(os.path.join(series_dir, SERIES_COMPLETE_MARKER))
+
+            # mark quiet series as complete
+            for series_dir, last_update in list(series_last_update.items()):
+                if time.time() - last_update >= series_quiet_period:
+                    logger.log(LogLevel.INFO.value, f"Series complete ({len(series_instances[series_dir])} instances): {series_dir}")
+                    write_series_complete(series_dir, len(series_instances[series_dir]))
+                    del series_last_update[series_dir]
+
+            if stats:
+                last_activity = time.time()
+            if watch_timeout is not None and not series_last_update and time.time() - last_activity >= watch_timeout:
+                logger.log(LogLevel.INFO.value, f"No new DICOMs for {watch_timeout}s. Stopping...")
+                break
+
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        logger.log(LogLevel.INFO.value, "Stopped watching.")
+
+    # the index is pruned once rather than on every poll
+    if kwargs.get('use_index', True):
+        index = open_index(os.path.join(output_dir, "dicomsort_index.sqlite"))
+        num_pruned = prune_index(index, sorted_locs)
+        if num_pruned:
+            logger.log(LogLevel.INFO.value, f"Removed {num_pruned} missing files from the DICOM index.")
+        index.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -143,7 +507,8 @@ if __name__ == "__main__":
 
     parser.add_argument(
         'input_dir',
-        help='Input DICOM directory to be recursively searched for DICOM files.'
+        help='Input DICOM directory to be recursively searched for DICOM files. Zip and tar archives (including '+
+             'compressed tar archives) found in the directory, or given directly as input, are read without extraction.'
     )
 
     parser.add_argument(
@@ -177,11 +542,71 @@ if __name__ == "__main__":
              'default this is on when input_dir == output_dir'
     )
 
+    parser.add_argument(
+        '--placement',
+        default='copy',
+        choices=['copy', 'move', 'hardlink', 'reflink'],
+        help='How DICOMs that do not require decompression are placed into the sorted folder structure. \'move\' '+
+             'renames the originals, \'hardlink\' creates hard links to the originals (same filesystem only), and '+
+             '\'reflink\' creates copy-on-write clones (e.g. XFS or Btrfs). These turn a full data copy into a '+
+             'metadata operation and fall back to a copy where unsupported. Compressed DICOMs are always rewritten '+
+             'after decompression.'
+    )
+
+    parser.add_argument(
+        '--no_index',
+        action='store_true',
+        help='Disables the persistent DICOM index (dicomsort_index.sqlite in the output directory). By default, '+
+             'headers are cached in the index so that reruns only parse new or changed files.'
+    )
+
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep running and poll input_dir for newly arrived DICOMs, sorting files once their size and '+
+             'modification time stop changing. Once no new instances arrive for a series for --series_quiet_period '+
+             f'seconds, a marker file \'{SERIES_COMPLETE_MARKER}\' is written to the series folder so '+
+             'that downstream conversion can start per series.'
+    )
+
+    parser.add_argument(
+        '--poll_interval',
+        type=float,
+        default=10,
+        help='Seconds between polls of input_dir in --watch mode.'
+    )
+
+    parser.add_argument(
+        '--series_quiet_period',
+        type=float,
+        default=60,
+        help='Seconds without new instances after which a series is marked complete in --watch mode.'
+    )
+
+    parser.add_argument(
+        '--watch_timeout',
+        type=float,
+        default=None,
+        help='Stop --watch mode once no new files have arrived for this many seconds and all series are marked '+
+             'complete. By default, watching continues until interrupted.'
+    )
+
+    parser.add_argument(
+        '--n_procs',
+        type=int,
+        default=None,
+        help='Number of processes used to read, decompress and write DICOM files concurrently. By default, the '+
+             'number of available CPUs is used. The same number of threads is used to check files for DICOM headers.'
+    )
+
     args = parser.parse_args()
 
     args.input_dir = os.path.abspath(args.input_dir)
     args.output_dir = os.path.abspath(args.output_dir)
 
+    if not args.n_procs:
+        args.n_procs = int(os.environ["NCPUS"] if "NCPUS" in os.environ else os.cpu_count())
+
     os.makedirs(args.output_dir, exist_ok=True)
 
     logger = make_logger(
@@ -218,14 +643,31 @@ if __name__ == "__main__":
         f.write("\n\n - Weston A. alex-weston-13/sort_dicoms.py. GitHub; 2020. https://gist.github.com/alex-weston-13/4dae048b423f1b4cb9828734a4ec8b83")
         f.write("\n\n")
 
-    dicomsort(
-        input_dir=args.input_dir,
-        output_dir=args.output_dir,
-        use_patient_names=args.use_patient_names,
-        use_session_dates=args.use_session_dates,
-        check_all_files=args.check_all_files,
-        delete_originals=args.input_dir == args.output_dir or args.delete_originals
-    )
+    dicomsort_args = {
+        'use_patient_names' : args.use_patient_names,
+        'use_session_dates' : args.use_session_dates,
+        'check_all_files' : args.check_all_files,
+        'delete_originals' : args.input_dir == args.output_dir or args.delete_originals,
+        'n_procs' : args.n_procs,
+        'placement' : args.placement,
+        'use_index' : not args.no_index
+    }
+
+    if args.watch:
+        dicomsort_watch(
+            input_dir=args.input_dir,
+            output_dir=args.output_dir,
+            poll_interval=args.poll_interval,
+            series_quiet_period=args.series_quiet_period,
+            watch_timeout=args.watch_timeout,
+            **dicomsort_args
+        )
+    else:
+        dicomsort(
+            input_dir=args.input_dir,
+            output_dir=args.output_dir,
+            **dicomsort_args
+        )
 
     show_warning_summary(logger)
 
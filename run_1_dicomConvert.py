@@ -7,10 +7,21 @@ import glob
 import json
 import fnmatch
 import datetime
+import hashlib
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
 
 from scripts.qsmxt_functions import get_qsmxt_version, get_diff
 from scripts.logger import LogLevel, make_logger, show_warning_summary 
 from scripts.nii_fix_ge import fix_ge_polar, fix_ge_complex
+from run_0_dicomSort import dicomsort, find_empty_dirs
+from scripts.dicom_index import open_index
+
+JSON_CACHE = '.qsmxt_json_cache.json'
+SERIES_STATE = 'dcm2niix_series.json'
+UNSORTED_DIR = '.qsmxt_unsorted_dicoms'
+UNSORTED_STATE = 'dicomsort_state.json'
 
 def sys_cmd(cmd):
     logger.log(LogLevel.INFO.value, f"Running command: '{cmd}'")
@@ -44,71 +55,277 @@ def rename(old, new, always_show=False):
         os.makedirs(os.path.split(new)[0], exist_ok=True)
     os.rename(old, new)
 
+def get_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def find_sidecars(output_dir):
+    json_files = []
+    for subject in get_folders_in(output_dir):
+        for session in get_folders_in(os.path.join(output_dir, subject)):
+            json_files.extend(sorted(
+                json_file for json_file in glob.glob(os.path.join(output_dir, subject, session, "extra_data", "*json"))
+                if os.path.split(json_file)[1] != SERIES_STATE
+            ))
+    return json_files
+
+def load_json_cache(path):
+    if not os.path.exists(path): return {}
+    try:
+        return load_json(path)
+    except (OSError, ValueError):
+        logger.log(LogLevel.WARNING.value, f"Unable to read JSON header cache '{path}'! Ignoring...")
+        return {}
+
+def save_json_cache(path, json_table):
+    with open(path, 'w', encoding='utf-8') as cache_file:
+        json.dump(json_table, cache_file)
+
+def load_sidecars(json_files, json_cache=None):
+    # returns {json_file: {'size', 'mtime_ns', 'data'}}; files unchanged since they were cached are not re-read
+    json_cache = json_cache if json_cache is not None else {}
+    json_table = {}
+    for json_file in json_files:
+        size, mtime_ns = get_stat(json_file)
+        cached = json_cache.get(json_file)
+        if cached and cached['size'] == size and cached['mtime_ns'] == mtime_ns:
+            json_table[json_file] = cached
+        else:
+            json_table[json_file] = { 'size' : size, 'mtime_ns' : mtime_ns, 'data' : load_json(json_file) }
+    return json_table
+
+def update_sidecars(json_table, json_files):
+    # reloads the given sidecars only, dropping any that no longer exist
+    json_table = dict(json_table)
+    for json_file in json_files:
+        json_table.pop(json_file, None)
+    json_table.update(load_sidecars([json_file for json_file in json_files if os.path.exists(json_file)]))
+    return { json_file : json_table[json_file] for json_file in sorted(json_table.keys(), key=lambda f: (os.path.dirname(f), f)) }
+
 def clean(data): 
     return data.replace('_', '')
 
 def get_folders_in(folder, full_path=False):
-    folders = list(filter(os.path.isdir, [os.path.join(folder, d) for d in os.listdir(folder)]))
+    folders = list(filter(os.path.isdir, [os.path.join(folder, d) for d in os.listdir(folder) if not d.startswith('.')]))
     if full_path: return folders
     folders = [os.path.split(folder)[1] for folder in folders]
     return folders
 
-def convert_to_nifti(input_dir, output_dir, t2starw_protocol_patterns, t1w_protocol_patterns, auto_yes):
+def merge_logs(log_paths, merged_log_path):
+    with open(merged_log_path, 'a', encoding='utf-8') as merged_log:
+        for log_path in log_paths:
+            if os.path.exists(log_path):
+                with open(log_path, encoding='utf-8', errors='replace') as log:
+                    merged_log.write(log.read())
+                os.remove(log_path)
+
+def get_series_digest(series_dicom_folder, dicom_sources=None):
+    # cheap digest of a series' instances (file names include the instance UIDs), sizes and modification times;
+    # dicom_sources ({path: description}) describes staged files by their source instead (see stage_unsorted_dicoms)
+    digest = hashlib.sha1()
+    for entry in sorted(os.scandir(series_dicom_folder), key=lambda entry: entry.name):
+        if entry.name.startswith('.') or not entry.is_file(): continue
+        if dicom_sources and entry.path in dicom_sources:
+            digest.update(f"{entry.name}:{dicom_sources[entry.path]}\n".encode('utf-8'))
+            continue
+        stat = entry.stat()
+        digest.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def stage_unsorted_dicoms(input_dir, staging_dir, use_patient_names, use_session_dates, check_all_files, n_procs=1):
+    # groups unsorted DICOMs into a {subject}/{session}/{series} tree of symbolic links (compressed DICOMs are
+    # decompressed into it) that is kept between runs along with its DICOM index and subject/session numbering,
+    # so that reruns give the same series folders; returns {staged path: SOPInstanceUID and source stat}
+    state_path = os.path.join(staging_dir, UNSORTED_STATE)
+    state = load_json(state_path) if os.path.exists(state_path) else {}
+    placed = dicomsort(
+        input_dir=input_dir,
+        output_dir=staging_dir,
+        use_patient_names=use_patient_names,
+        use_session_dates=use_session_dates,
+        check_all_files=check_all_files,
+        delete_originals=False,
+        n_procs=n_procs,
+        placement='symlink',
+        use_index=True,
+        state=state
+    )
+    with open(state_path, 'w', encoding='utf-8') as state_file:
+        json.dump({ key : state[key] for key in ['subjName_dates', 'subjName_sessionNums'] }, state_file)
+
+    # remove staged files whose source is no longer in the input
+    placed_paths = set(out_path for dicom_loc, out_path in placed)
+    for root, dirs, files in os.walk(staging_dir):
+        for f in files:
+            if f.endswith('.dcm') and os.path.join(root, f) not in placed_paths:
+                os.remove(os.path.join(root, f))
+    for empty_dir in find_empty_dirs(staging_dir):
+        if empty_dir != staging_dir: os.rmdir(empty_dir)
+
+    # staged files are described by their source, as decompressed copies are rewritten on every run
+    index = open_index(os.path.join(staging_dir, "dicomsort_index.sqlite"))
+    dicom_sources = {}
+    for dicom_loc, out_path in placed:
+        row = index.execute("SELECT sop_instance_uid, size, mtime_ns FROM dicoms WHERE path = ?", (dicom_loc,)).fetchone()
+        if row: dicom_sources[out_path] = f"{row[0]}:{dicom_loc}:{row[1]}:{row[2]}"
+    index.close()
+    return dicom_sources
+
+def load_series_state(path):
+    # {'series': {series: {'digest', 'outputs'}}, 'renames': {path relative to the session: original name}}
+    if not os.path.exists(path):
+        return { 'series' : {}, 'renames' : {} }
+    return load_json(path)
+
+def save_series_state(path, state):
+    with open(path, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file)
+
+def get_series_outputs(session_extra_folder, series):
+    # dcm2niix output names begin with the series folder name (%f); the longest matching series name wins
+    outputs = {s : [] for s in series}
+    for f in sorted(os.listdir(session_extra_folder)):
+        owners = [s for s in series if f.startswith(s) and f[len(s):len(s)+1] in ['_', '.']]
+        if owners:
+            outputs[max(owners, key=len)].append(f)
+    return outputs
+
+def convert_to_nifti(input_dir, output_dir, t2starw_protocol_patterns, t1w_protocol_patterns, auto_yes, n_procs=1, dicom_sources=None):
     logger.log(LogLevel.INFO.value, 'Converting all DICOMs to NIfTI...')
+    session_logs = {}
+    session_conversions = {}
+    dcm2niix_cmds = []
     subjects = get_folders_in(input_dir)
     for subject in subjects:
         sessions = get_folders_in(os.path.join(input_dir, subject))
         for session in sessions:
-            session_extra_folder = os.path.join(output_dir, clean(subject), session, "extra_data")
+            session_folder = os.path.join(output_dir, clean(subject), session)
+            session_extra_folder = os.path.join(session_folder, "extra_data")
+            session_state_path = os.path.join(session_extra_folder, SERIES_STATE)
             os.makedirs(session_extra_folder, exist_ok=True)
-            if 'dcm2niix_output.txt' in os.listdir(session_extra_folder):
+            if 'dcm2niix_output.txt' in os.listdir(session_extra_folder) and not os.path.exists(session_state_path):
                 logger.log(LogLevel.WARNING.value, f'{session_extra_folder} already has dcm2niix conversion output! Skipping...')
                 continue
+
+            # only series that were added or modified since the last conversion are converted
+            state = load_series_state(session_state_path)
             series = get_folders_in(os.path.join(input_dir, subject, session))
-            for s in series:
+            digests = { s : get_series_digest(os.path.join(input_dir, subject, session, s), dicom_sources) for s in series }
+            changed_series = [s for s in series if state['series'].get(s, {}).get('digest') != digests[s]]
+            removed_series = [s for s in state['series'] if s not in series]
+            if not changed_series and not removed_series:
+                logger.log(LogLevel.INFO.value, f'{session_extra_folder} is up to date. Skipping...')
+                continue
+            logger.log(LogLevel.INFO.value, f"{session_folder}: {len(changed_series)} new or modified series; {len(series) - len(changed_series)} unchanged series; {len(removed_series)} removed series.")
+
+            # move previously renamed files back so that runs and echoes are numbered across the whole session
+            for new_name, old_name in state['renames'].items():
+                if os.path.exists(os.path.join(session_folder, new_name)):
+                    rename(os.path.join(session_folder, new_name), os.path.join(session_extra_folder, old_name))
+            state['renames'] = {}
+
+            # remove outdated outputs
+            for s in changed_series + removed_series:
+                for f in state['series'].pop(s, {}).get('outputs', []):
+                    if os.path.exists(os.path.join(session_extra_folder, f)):
+                        os.remove(os.path.join(session_extra_folder, f))
+            save_series_state(session_state_path, state)
+
+            session_logs[os.path.join(session_extra_folder, 'dcm2niix_output.txt')] = []
+            session_conversions[session_state_path] = (series, { s : digests[s] for s in changed_series })
+            for s in changed_series:
+                # each series logs to its own file; logs are merged per session once all conversions finish
                 series_dicom_folder = os.path.join(input_dir, subject, session, s)
-                sys_cmd(f"dcm2niix -z n -o \"{session_extra_folder}\" \"{series_dicom_folder}\" >> \"{os.path.join(session_extra_folder, 'dcm2niix_output.txt')}\"")
+                series_log = os.path.join(session_extra_folder, f"dcm2niix_output_{s}.txt")
+                session_logs[os.path.join(session_extra_folder, 'dcm2niix_output.txt')].append(series_log)
+                dcm2niix_cmds.append((session_state_path, s, f"dcm2niix -z n -o \"{session_extra_folder}\" \"{series_dicom_folder}\" > \"{series_log}\""))
+
+    # failed series are not recorded and are converted again next time
+    converted_files = set()
+    if session_conversions:
+        # series are converted concurrently - dcm2niix is single-threaded for uncompressed output
+        logger.log(LogLevel.INFO.value, f"Running {len(dcm2niix_cmds)} dcm2niix conversions using {n_procs} processes...")
+        with ThreadPoolExecutor(max_workers=max(1, n_procs)) as executor:
+            return_codes = list(executor.map(sys_cmd, [cmd for (session_state_path, s, cmd) in dcm2niix_cmds]))
+        for merged_log_path, log_paths in session_logs.items():
+            merge_logs(log_paths, merged_log_path)
+
+        for (session_state_path, s, cmd), return_code in zip(dcm2niix_cmds, return_codes):
+            if return_code:
+                session_conversions[session_state_path][1].pop(s)
+        for session_state_path, (series, digests) in session_conversions.items():
+            outputs = get_series_outputs(os.path.dirname(session_state_path), series)
+            for s in digests:
+                converted_files.update(os.path.join(os.path.dirname(session_state_path), f) for f in outputs[s])
+    else:
+        logger.log(LogLevel.INFO.value, 'No new or modified series to convert.')
     
     logger.log(LogLevel.INFO.value, f"Loading JSON headers from '{output_dir}/.../extra_data' folders...")
     subjects = get_folders_in(output_dir)
-    json_files = []
-    json_datas = []
-    for subject in subjects:
-        sessions = get_folders_in(os.path.join(output_dir, subject))
-        for session in sessions:
-            session_extra_folder = os.path.join(output_dir, subject, session, "extra_data")
-            json_files.extend(sorted(glob.glob(os.path.join(session_extra_folder, "*json"))))
-            json_datas.extend([load_json(json_file) for json_file in sorted(glob.glob(os.path.join(session_extra_folder, "*json")))])
+    json_cache_path = os.path.join(output_dir, JSON_CACHE)
+    json_table = load_sidecars(find_sidecars(output_dir), load_json_cache(json_cache_path))
+    save_json_cache(json_cache_path, json_table)
+    json_files = list(json_table.keys())
+    json_datas = [json_table[json_file]['data'] for json_file in json_files]
+
+    if not session_conversions and not json_files:
+        logger.log(LogLevel.INFO.value, f"No JSON headers awaiting renaming in '{output_dir}/.../extra_data' folders.")
+        return
 
+    # only outputs converted during this run are corrected; unchanged series were corrected when first converted
     logger.log(LogLevel.INFO.value, f"Checking for GE data requiring correction...")
-    ge_corrections = False
+    changed_json_files = []
+    ge_corrections = []
     for i in range(len(json_datas)):
+        if json_files[i] not in converted_files:
+            continue
         if any([x in json_files[i] for x in ['_ph.json', '_real.json']]):
             if "Manufacturer" not in json_datas[i]:
                 logger.log(LogLevel.WARNING.value, f"'Manufacturer' missing from JSON header '{json_files[i]}'. Unable to determine whether any GE data requires correction. You may need to manually run nii-fix-ge.py to correct complex or four.")
                 continue
-            ge_corrections = True
             if json_datas[i]["Manufacturer"].upper().strip() in ["GE", "GE MEDICAL SYSTEMS"]:
                 if '_ph.json' in json_files[i]:
                     phase_path = glob.glob(json_files[i].replace('.json', '.nii*'))[0]
                     mag_path = glob.glob(json_files[i].replace('_ph.json', '.nii*'))[0]
                     logger.log(LogLevel.INFO.value, f"Correcting GE data: phase={phase_path}; mag={mag_path}")
-                    fix_ge_polar(mag_path, phase_path, delete_originals=True)
+                    ge_corrections.append((fix_ge_polar, mag_path, phase_path))
                 else: # if '_real.json' in json_files[i]:
                     real_path = glob.glob(json_files[i].replace('.json', '.nii*'))[0]
                     imag_path = glob.glob(json_files[i].replace('_real.json', '_imaginary.nii*'))[0]
                     logger.log(LogLevel.INFO.value, f"Correcting GE data: real={real_path}; imag={imag_path}")
-                    fix_ge_complex(real_path, imag_path, delete_originals=True)
+                    ge_corrections.append((fix_ge_complex, real_path, imag_path))
+
+                    # the real/imaginary headers are replaced by magnitude/phase headers
+                    changed_json_files.extend([
+                        json_files[i],
+                        json_files[i].replace('_real.json', '_imaginary.json'),
+                        json_files[i].replace('_real.json', '.json'),
+                        json_files[i].replace('_real.json', '_ph.json')
+                    ])
     if ge_corrections:
-        logger.log(LogLevel.INFO.value, f"Loading updated JSON headers from '{output_dir}/.../extra_data' folders...")
-        json_files = []
-        json_datas = []
-        for subject in subjects:
-            sessions = get_folders_in(os.path.join(output_dir, subject))
-            for session in sessions:
-                session_extra_folder = os.path.join(output_dir, subject, session, "extra_data")
-                json_files.extend(sorted(glob.glob(os.path.join(session_extra_folder, "*json"))))
-                json_datas.extend([load_json(json_file) for json_file in sorted(glob.glob(os.path.join(session_extra_folder, "*json")))])
+        # series are corrected concurrently, sharing the available threads between FFTs
+        with ThreadPoolExecutor(max_workers=max(1, min(n_procs, len(ge_corrections)))) as executor:
+            futures = [
+                executor.submit(fix_ge, path1, path2, delete_originals=True, workers=max(1, n_procs // len(ge_corrections)))
+                for (fix_ge, path1, path2) in ge_corrections
+            ]
+            for future in futures:
+                future.result()
+
+    # outputs are recorded after GE correction, which replaces real/imaginary outputs with magnitude/phase
+    for session_state_path, (series, digests) in session_conversions.items():
+        state = load_series_state(session_state_path)
+        outputs = get_series_outputs(os.path.dirname(session_state_path), series)
+        for s, digest in digests.items():
+            state['series'][s] = { 'digest' : digest, 'outputs' : outputs[s] }
+        save_series_state(session_state_path, state)
+
+    if changed_json_files:
+        logger.log(LogLevel.INFO.value, f"Loading updated JSON headers...")
+        json_table = update_sidecars(json_table, changed_json_files)
+        save_json_cache(json_cache_path, json_table)
+        json_files = list(json_table.keys())
+        json_datas = [json_table[json_file]['data'] for json_file in json_files]
 
     logger.log(LogLevel.INFO.value, f"Enumerating protocol names from JSON headers...")
     all_protocol_names = []
@@ -141,6 +358,10 @@ def convert_to_nifti(input_dir, output_dir, t2starw_protocol_patterns, t1w_proto
             for protocol_name in all_protocol_names:
                 if fnmatch.fnmatch(protocol_name, t2starw_protocol_pattern):
                     t2starw_protocol_names.append(protocol_name)
+        if not t2starw_protocol_names and not session_conversions:
+            # remaining sidecars from a previous run that do not match the patterns are left in place
+            logger.log(LogLevel.INFO.value, "No T2Star weighted protocols awaiting renaming.")
+            return
         if not t2starw_protocol_names:
             logger.log(LogLevel.ERROR.value, "No T2Star weighted protocols identified! Exiting...")
             script_exit(1)
@@ -218,10 +439,9 @@ def convert_to_nifti(input_dir, output_dir, t2starw_protocol_patterns, t1w_proto
             logger.log(LogLevel.INFO.value, f"Parsing relevant JSON data from {subject}/{session}...")
             session_extra_folder = os.path.join(output_dir, subject, session, "extra_data")
             session_anat_folder = os.path.join(output_dir, subject, session, "anat")
-            json_files = sorted(glob.glob(os.path.join(session_extra_folder, "*json")))
             session_details = []
-            for json_file in json_files:
-                json_data = load_json(json_file)
+            for json_file in [json_file for json_file in json_files if os.path.dirname(json_file) == session_extra_folder]:
+                json_data = json_table[json_file]['data']
                 if 'Modality' not in json_data:
                     logger.log(LogLevel.WARNING.value, f"'Modality' missing from JSON header '{json_file}'! Skipping...")
                 elif 'ProtocolName' not in json_data:
@@ -303,6 +523,18 @@ def convert_to_nifti(input_dir, output_dir, t2starw_protocol_patterns, t1w_proto
     for details in all_session_details:
         rename(details['file_name']+'.json', details['new_name']+'.json', always_show=auto_yes)
         rename(details['file_name']+'.nii', details['new_name']+'.nii', always_show=auto_yes)
+
+    # record renames so that files can be restored if the session is converted again
+    for session_extra_folder in sorted(set(os.path.dirname(details['file_name']) for details in all_session_details)):
+        session_state_path = os.path.join(session_extra_folder, SERIES_STATE)
+        if not os.path.exists(session_state_path): continue
+        state = load_series_state(session_state_path)
+        for details in all_session_details:
+            if os.path.dirname(details['file_name']) != session_extra_folder: continue
+            for extension in ['.json', '.nii']:
+                new_name = os.path.relpath(details['new_name'] + extension, os.path.dirname(session_extra_folder))
+                state['renames'][new_name] = os.path.split(details['file_name'])[1] + extension
+        save_series_state(session_state_path, state)
     
     # create required dataset_description.json file
     logger.log(LogLevel.INFO.value, 'Generating details for BIDS datset_description.json...')
@@ -323,6 +555,7 @@ def convert_to_nifti(input_dir, output_dir, t2starw_protocol_patterns, t1w_proto
     logger.log(LogLevel.INFO.value, 'Writing BIDS .bidsignore file...')
     with open(os.path.join(args.output_dir, '.bidsignore'), 'w', encoding='utf-8') as bidsignore_file:
         bidsignore_file.write('*dcm2niix_output.txt\n')
+        bidsignore_file.write(f'*{SERIES_STATE}\n')
         bidsignore_file.write('references.txt\n')
 
     logger.log(LogLevel.INFO.value, 'Writing BIDS dataset README...')
@@ -374,11 +607,50 @@ if __name__ == "__main__":
              'run_3_segment.py script for automated brain segmentation and registration to the QSM space.'
     )
 
+    parser.add_argument(
+        '--unsorted',
+        action='store_true',
+        help='Treat input_dir as an unsorted DICOM directory (e.g. a scanner export) rather than the output of '+
+             'run_0_dicomSort.py. DICOMs are grouped by subject, session and series from their headers alone and '+
+             'converted from their original locations via a folder of symbolic links, so that the raw data is read '+
+             f'once and written once as NIfTI. Compressed DICOMs are decompressed into this folder. The folder '+
+             f'({UNSORTED_DIR} in the output directory) is kept so that reruns only convert new or modified series.'
+    )
+
+    parser.add_argument(
+        '--use_patient_names',
+        action='store_true',
+        help='With --unsorted, use the DICOM \'PatientName\' field rather than \'PatientID\' to identify subjects.'
+    )
+
+    parser.add_argument(
+        '--use_session_dates',
+        action='store_true',
+        help='With --unsorted, use the \'StudyDate\' field rather than an incrementer to identify scanning sessions.'
+    )
+
+    parser.add_argument(
+        '--check_all_files',
+        action='store_true',
+        help='With --unsorted, ignores the DICOM file extensions .dcm and .IMA and instead reads all files for valid '+
+             'DICOM headers. This is useful if some of your DICOM files have unusual file extensions or none at all.'
+    )
+
+    parser.add_argument(
+        '--n_procs',
+        type=int,
+        default=None,
+        help='Number of dcm2niix conversions to run concurrently. By default, the number of available CPUs is used.'
+    )
+
     args = parser.parse_args()
 
     args.input_dir = os.path.abspath(args.input_dir)
     args.output_dir = os.path.abspath(args.output_dir)
 
+    if not args.n_procs:
+        args.n_procs = int(os.environ["NCPUS"] if "NCPUS" in os.environ else os.cpu_count())
+
     os.makedirs(args.output_dir, exist_ok=True)
 
     logger = make_logger(
@@ -417,12 +689,29 @@ if __name__ == "__main__":
         f.write("\n\n - Gorgolewski KJ, Auer T, Calhoun VD, et al. The brain imaging data structure, a format for organizing and describing outputs of neuroimaging experiments. Sci Data. 2016;3(1):160044. doi:10.1038/sdata.2016.44")
         f.write("\n\n")
     
+    # group unsorted DICOMs into a {subject}/{session}/{series} tree of symbolic links kept in the output directory
+    dicom_dir = args.input_dir
+    dicom_sources = None
+    if args.unsorted:
+        dicom_dir = os.path.join(args.output_dir, UNSORTED_DIR)
+        logger.log(LogLevel.INFO.value, f"Grouping unsorted DICOMs from {args.input_dir} in {dicom_dir}...")
+        dicom_sources = stage_unsorted_dicoms(
+            input_dir=args.input_dir,
+            staging_dir=dicom_dir,
+            use_patient_names=args.use_patient_names,
+            use_session_dates=args.use_session_dates,
+            check_all_files=args.check_all_files,
+            n_procs=args.n_procs
+        )
+
     convert_to_nifti(
-        input_dir=args.input_dir,
+        input_dir=dicom_dir,
         output_dir=args.output_dir,
         t2starw_protocol_patterns=[pattern.lower() for pattern in args.t2starw_protocol_patterns],
         t1w_protocol_patterns=[pattern.lower() for pattern in args.t1w_protocol_patterns],
-        auto_yes=args.auto_yes
+        auto_yes=args.auto_yes,
+        n_procs=args.n_procs,
+        dicom_sources=dicom_sources
     )
 
     script_exit()
@@ -7,8 +7,9 @@ import json
 import shutil
 import datetime
 
-from fnmatch import fnmatch
-from re import findall
+from fnmatch import translate
+from concurrent.futures import ThreadPoolExecutor
+import re
 
 from scripts.qsmxt_functions import get_qsmxt_version, get_diff
 from scripts.logger import LogLevel, make_logger, show_warning_summary 
@@ -44,14 +45,37 @@ def flatten(a):
     return [i for g in a for i in g]
 
 
-def find_files_with_extension(input_dir, extension):
+def scan_dir(directory):
+    # returns the files and subdirectories of a directory
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def find_files_with_extension(input_dir, extension, n_threads=1):
+    # directories are scanned level by level using a thread pool, as listing is I/O-bound
+    extension = tuple(extension) if isinstance(extension, list) else extension
     file_list = []
-    for root, dirs, files in os.walk(input_dir):
-        for f in files:
-            if (isinstance(extension, list) and any(f.endswith(a) for a in extension)):
-                file_list.append(os.path.join(root, f))
-            elif isinstance(extension, str) and f.endswith(extension):
-                file_list.append(os.path.join(root, f))
+    directories = [input_dir]
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        while directories:
+            subdirs = []
+            for files, dir_subdirs in executor.map(scan_dir, directories):
+                file_list.extend(f for f in files if os.path.split(f)[1].endswith(extension))
+                subdirs.extend(dir_subdirs)
+            directories = subdirs
     return file_list
 
 
@@ -117,18 +141,36 @@ def get_details_from_csv(csv_file):
     return all_details
 
 
+def compile_patterns(patterns):
+    # compiles glob patterns into a single regular expression, or None if there are no patterns
+    if not patterns: return None
+    return re.compile('|'.join(f"(?:{translate(pattern)})" for pattern in patterns))
+
+
 def get_details_from_filenames(file_list):
+    # patterns are compiled once rather than for every file
+    subject_pattern = re.compile(args.subject_pattern) if args.subject_pattern else None
+    session_pattern = re.compile(args.session_pattern) if args.session_pattern else None
+    run_pattern = re.compile(args.run_pattern) if args.run_pattern else None
+    echo_pattern = re.compile(args.echo_pattern) if args.echo_pattern else None
+    protocol_pattern = re.compile(args.protocol_pattern) if args.protocol_pattern else None
+    t1w_protocol_patterns = compile_patterns(args.t1w_protocol_patterns)
+    t2starw_protocol_patterns = compile_patterns(args.t2starw_protocol_patterns)
+    magnitude_pattern = compile_patterns([args.magnitude_pattern] if args.magnitude_pattern else None)
+    phase_pattern = compile_patterns([args.phase_pattern] if args.phase_pattern else None)
+    t1w_pattern = compile_patterns([args.t1w_pattern] if args.t1w_pattern else None)
+
     all_details = []
     for nifti_file in file_list:
         details = {}
         details['filename'] = nifti_file
         details['directory'] = os.path.split(nifti_file)[0]
 
-        subject_matches = findall(args.subject_pattern, nifti_file) if args.subject_pattern else None
-        session_matches = findall(args.session_pattern, nifti_file) if args.session_pattern else None
-        run_matches = findall(args.run_pattern, nifti_file) if args.run_pattern else None
-        echo_matches = findall(args.echo_pattern, nifti_file) if args.echo_pattern else None
-        protocol_matches = findall(args.protocol_pattern, nifti_file) if args.protocol_pattern else None
+        subject_matches = subject_pattern.findall(nifti_file) if subject_pattern else None
+        session_matches = session_pattern.findall(nifti_file) if session_pattern else None
+        run_matches = run_pattern.findall(nifti_file) if run_pattern else None
+        echo_matches = echo_pattern.findall(nifti_file) if echo_pattern else None
+        protocol_matches = protocol_pattern.findall(nifti_file) if protocol_pattern else None
 
         details['subject_id'] = subject_matches[0] if subject_matches else None
         details['session_id'] = session_matches[0] if session_matches else None
@@ -144,14 +186,14 @@ def get_details_from_filenames(file_list):
         details['part_type'] = None
 
         if details['protocol_name']:
-            if args.t1w_protocol_patterns and any([fnmatch(details['protocol_name'], pattern) for pattern in args.t1w_protocol_patterns]):
+            if t1w_protocol_patterns and t1w_protocol_patterns.match(details['protocol_name']):
                 details['series_type'] = 't1w'
-            if args.t2starw_protocol_patterns and any([fnmatch(details['protocol_name'], pattern) for pattern in args.t2starw_protocol_patterns]):
+            if t2starw_protocol_patterns and t2starw_protocol_patterns.match(details['protocol_name']):
                 details['series_type'] = 't2starw'
 
-        magnitude = fnmatch(nifti_file, args.magnitude_pattern) if args.magnitude_pattern else None
-        phase = fnmatch(nifti_file, args.phase_pattern) if args.phase_pattern else None
-        t1 = fnmatch(nifti_file, args.t1w_pattern) if args.t1w_pattern else None
+        magnitude = bool(magnitude_pattern.match(nifti_file)) if magnitude_pattern else None
+        phase = bool(phase_pattern.match(nifti_file)) if phase_pattern else None
+        t1 = bool(t1w_pattern.match(nifti_file)) if t1w_pattern else None
 
         if t1: 
             details['series_type'] = 't1w'
@@ -166,11 +208,19 @@ def get_details_from_filenames(file_list):
     return all_details
 
 
-def update_details_with_jsons(all_details):
-    for details in all_details:
-        json_file = json_filename(details['filename'])
-        if os.path.exists(json_file):
-            json_data = load_json(json_file)
+def load_json_if_exists(path):
+    return load_json(path) if os.path.exists(path) else None
+
+
+def update_details_with_jsons(all_details, n_threads=1):
+    t1w_protocol_patterns = compile_patterns(args.t1w_protocol_patterns)
+    t2starw_protocol_patterns = compile_patterns(args.t2starw_protocol_patterns)
+
+    # sidecars are loaded concurrently and applied in order as they arrive
+    json_files = [json_filename(details['filename']) for details in all_details]
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        for details, json_data in zip(all_details, executor.map(load_json_if_exists, json_files)):
+            if json_data is None: continue
             if 'EchoTime' in json_data:
                 try: details['echo_time'] = float(json_data['EchoTime'])
                 except: pass
@@ -182,9 +232,9 @@ def update_details_with_jsons(all_details):
                 except: pass
             if 'ProtocolName' in json_data:
                 details['protocol_name'] = json_data['ProtocolName']
-                if args.t1w_protocol_patterns and any([fnmatch(details['protocol_name'], pattern) for pattern in args.t1w_protocol_patterns]):
+                if t1w_protocol_patterns and t1w_protocol_patterns.match(details['protocol_name']):
                     details['series_type'] = 't1w'
-                if args.t2starw_protocol_patterns and any([fnmatch(details['protocol_name'], pattern) for pattern in args.t2starw_protocol_patterns]):
+                if t2starw_protocol_patterns and t2starw_protocol_patterns.match(details['protocol_name']):
                     details['series_type'] = 't2starw'
             if 'ImageType' in json_data:
                 details['part_type'] = 'phase' if 'P' in json_data['ImageType'] else 'mag'
@@ -218,13 +268,13 @@ def nifti_to_bids(input_dir, output_dir):
         logger.log(LogLevel.INFO.value, f"CSV spreadsheet loaded.")
     else:
         logger.log(LogLevel.INFO.value, f"Finding NIfTI files...")
-        nifti_files = find_files_with_extension(args.input_dir, ['.nii', '.nii.gz'])
+        nifti_files = find_files_with_extension(args.input_dir, ['.nii', '.nii.gz'], n_threads=args.n_procs)
         logger.log(LogLevel.INFO.value, f"{len(nifti_files)} NIfTI files found.")
         logger.log(LogLevel.INFO.value, f"Extracting details from filenames using patterns...")
         all_details = get_details_from_filenames(nifti_files)
         logger.log(LogLevel.INFO.value, f"Done reading details.")
         logger.log(LogLevel.INFO.value, f"Updating details with JSON header information...")
-        all_details = update_details_with_jsons(all_details)
+        all_details = update_details_with_jsons(all_details, n_threads=args.n_procs)
         logger.log(LogLevel.INFO.value, f"Done reading JSON header files.")
 
     if any(value is None for value in flatten([list(details.values()) for details in all_details])):
@@ -402,6 +452,14 @@ if __name__ == "__main__":
         help='Force running non-interactively. This is useful when used as part of a script or on a testing server.'
     )
 
+    parser.add_argument(
+        '--n_procs',
+        type=int,
+        default=None,
+        help='Number of threads used to list directories and load JSON headers. By default, the number of available '+
+             'CPUs is used.'
+    )
+
     args = parser.parse_args()
 
     args.input_dir = os.path.abspath(args.input_dir)
@@ -409,6 +467,9 @@ if __name__ == "__main__":
     this_dir = os.path.dirname(os.path.abspath(__file__))
     csv_file = os.path.join(args.output_dir, 'dataset_qsmxt.csv')
 
+    if not args.n_procs:
+        args.n_procs = int(os.environ["NCPUS"] if "NCPUS" in os.environ else os.cpu_count())
+
     os.makedirs(args.output_dir, exist_ok=True)
 
     logger = make_logger(
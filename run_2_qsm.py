@@ -3,35 +3,50 @@
 import sys
 import os
 import psutil
-import glob
 import copy
+import shutil
 import argparse
 import json
+import nibabel as nib
 
 from nipype.interfaces.utility import IdentityInterface, Function
 from nipype.interfaces.io import DataSink
 from nipype.pipeline.engine import Workflow, Node, MapNode
+from nipype.interfaces.base import isdefined
 from nipype import config, logging
 from scripts.qsmxt_functions import get_qsmxt_version, get_qsmxt_dir, get_diff, print_qsm_premades, gen_plugin_args
 from scripts.sys_cmd import sys_cmd
 from scripts.logger import LogLevel, make_logger, show_warning_summary, get_logger
 from scripts.user_input import get_option, get_string, get_num, get_nums
+from scripts.bids_index import load_bids_index
+from scripts.qsmxt_dtypes import FLOAT_DTYPES
+from scripts.qsmxt_io import compress_outputs, decompress_inputs
 
 from interfaces import nipype_interface_romeo as romeo
-from interfaces import nipype_interface_process_phase as process_phase
 from interfaces import nipype_interface_makehomogeneous as makehomogeneous
-from interfaces import nipype_interface_axialsampling as sampling
+from interfaces import nipype_interface_preprocess as preprocess
 from interfaces import nipype_interface_twopass as twopass
 from interfaces import nipype_interface_nonzeroaverage as nonzeroaverage
 
 from workflows.qsm import qsm_workflow
 from workflows.masking import masking_workflow
 
+def load_json(path):
+    f = open(path, encoding='utf-8')
+    j = json.load(f)
+    f.close()
+    return j
+
 def init_workflow(args):
     logger = get_logger('main')
+
+    # list the BIDS directory once; all patterns are resolved against the index in memory
+    logger.log(LogLevel.INFO.value, f"Indexing {args.bids_dir}...")
+    bids_index = load_bids_index(args.bids_dir, os.path.join(args.output_dir, "bids_index.json") if os.path.isdir(args.output_dir) else None)
+
     subjects = [
         os.path.split(path)[1]
-        for path in glob.glob(os.path.join(args.bids_dir, args.subject_pattern))
+        for path in bids_index.glob(os.path.join(args.bids_dir, args.subject_pattern))
         if not args.subjects or os.path.split(path)[1] in args.subjects
     ]
     if not subjects:
@@ -40,16 +55,16 @@ def init_workflow(args):
     wf = Workflow("workflow_qsm", base_dir=args.output_dir)
     wf.add_nodes([
         node for node in
-        [init_subject_workflow(args, subject) for subject in subjects]
+        [init_subject_workflow(args, subject, bids_index) for subject in subjects]
         if node
     ])
     return wf
 
-def init_subject_workflow(args, subject):
+def init_subject_workflow(args, subject, bids_index):
     logger = get_logger('main')
     sessions = [
         os.path.split(path)[1]
-        for path in glob.glob(os.path.join(args.bids_dir, subject, args.session_pattern))
+        for path in bids_index.glob(os.path.join(args.bids_dir, subject, args.session_pattern))
         if not args.sessions or os.path.split(path)[1] in args.sessions
     ]
     if not sessions:
@@ -58,16 +73,16 @@ def init_subject_workflow(args, subject):
     wf = Workflow(subject, base_dir=os.path.join(args.output_dir, "workflow_qsm"))
     wf.add_nodes([
         node for node in
-        [init_session_workflow(args, subject, session) for session in sessions]
+        [init_session_workflow(args, subject, session, bids_index) for session in sessions]
         if node
     ])
     return wf
 
-def init_session_workflow(args, subject, session):
+def init_session_workflow(args, subject, session, bids_index):
     logger = get_logger('main')
     # exit if no runs found
     phase_pattern = os.path.join(args.bids_dir, args.phase_pattern.replace("{run}", "").format(subject=subject, session=session))
-    phase_files = glob.glob(phase_pattern)
+    phase_files = bids_index.glob(phase_pattern)
     if not phase_files:
         logger.log(LogLevel.WARNING.value, f"No phase files found matching pattern: {phase_pattern}. Skipping {subject}/{session}")
         return
@@ -85,27 +100,45 @@ def init_session_workflow(args, subject, session):
     wf = Workflow(session, base_dir=os.path.join(args.output_dir, "workflow_qsm", subject, session))
     wf.add_nodes([
         node for node in
-        [init_run_workflow(copy.deepcopy(args), subject, session, run) for run in runs]
+        [init_run_workflow(copy.deepcopy(args), subject, session, run, bids_index) for run in runs]
         if node
     ])
     return wf
 
-def init_run_workflow(run_args, subject, session, run):
+def get_input_cache_dir(args):
+    return os.path.join(args.output_dir, "workflow_qsm", "input_cache")
+
+def decompress_workflow_inputs(wf, args):
+    # decompresses the gzipped inputs of all runs in one parallel batch and points each run's inputs at the copies
+    input_fields = ['phase', 'magnitude', 'mask']
+    input_nodes = [wf.get_node(name) for name in wf.list_node_names() if name.split('.')[-1] == 'nipype_getfiles']
+    input_files = [
+        path
+        for node in input_nodes for field in input_fields if isdefined(getattr(node.inputs, field))
+        for path in getattr(node.inputs, field)
+    ]
+    cached_files = dict(zip(input_files, decompress_inputs(input_files, get_input_cache_dir(args), args.bids_dir, args.n_procs)))
+    for node in input_nodes:
+        for field in input_fields:
+            if isdefined(getattr(node.inputs, field)):
+                setattr(node.inputs, field, [cached_files[path] for path in getattr(node.inputs, field)])
+
+def init_run_workflow(run_args, subject, session, run, bids_index):
     logger = get_logger('main')
     logger.log(LogLevel.INFO.value, f"Creating nipype workflow for {subject}/{session}/{run}...")
 
     # get relevant files from this run
     phase_pattern = os.path.join(run_args.bids_dir, run_args.phase_pattern.format(subject=subject, session=session, run=run))
-    phase_files = sorted(glob.glob(phase_pattern))[:run_args.num_echoes]
+    phase_files = sorted(bids_index.glob(phase_pattern))[:run_args.num_echoes]
     
     magnitude_pattern = os.path.join(run_args.bids_dir, run_args.magnitude_pattern.format(subject=subject, session=session, run=run))
-    magnitude_files = sorted(glob.glob(magnitude_pattern))[:run_args.num_echoes]
+    magnitude_files = sorted(bids_index.glob(magnitude_pattern))[:run_args.num_echoes]
 
     params_pattern = os.path.join(run_args.bids_dir, run_args.phase_pattern.format(subject=subject, session=session, run=run).replace("nii.gz", "nii").replace("nii", "json"))
-    params_files = sorted(glob.glob(params_pattern))[:run_args.num_echoes]
+    params_files = sorted(bids_index.glob(params_pattern))[:run_args.num_echoes]
     
     mask_pattern = os.path.join(run_args.bids_dir, run_args.mask_pattern.format(subject=subject, session=session, run=run))
-    mask_files = sorted(glob.glob(mask_pattern))[:run_args.num_echoes] if run_args.use_existing_masks else []
+    mask_files = sorted(bids_index.glob(mask_pattern))[:run_args.num_echoes] if run_args.use_existing_masks else []
     
     # handle any errors related to files and adjust any settings if needed
     if not phase_files:
@@ -114,6 +147,19 @@ def init_run_workflow(run_args, subject, session, run):
     if len(phase_files) != len(params_files):
         logger.log(LogLevel.WARNING.value, f"Skipping run {subject}/{session}/{run} - an unequal number of JSON and phase files are present.")
         return
+
+    # read echo times, field strength and voxel size now so they can be set as static node inputs
+    try:
+        params = [load_json(params_file) for params_file in params_files]
+        echo_times = [param['EchoTime'] for param in params]
+        B0 = params[0]['MagneticFieldStrength']
+        vsz = str(nib.load(phase_files[0]).header.get_zooms()).replace(" ", "")
+    except KeyError as e:
+        logger.log(LogLevel.WARNING.value, f"Skipping run {subject}/{session}/{run} - {e} missing from JSON header.")
+        return
+    except Exception as e:
+        logger.log(LogLevel.WARNING.value, f"Skipping run {subject}/{session}/{run} - unable to read JSON headers or phase header: {e}")
+        return
     if run_args.use_existing_masks:
         if not mask_files:
             logger.log(LogLevel.WARNING.value, f"Run {subject}/{session}/{run}: --use_existing_masks specified but no masks found matching pattern: {mask_pattern}. Reverting to {run_args.masking_algorithm} masking.")
@@ -164,142 +210,35 @@ def init_run_workflow(run_args, subject, session, run):
     if len(mask_files) == 1: mask_files = [mask_files[0] for _ in phase_files]
     n_inputs.inputs.mask = mask_files
 
-    # read echotime and field strengths from json files
-    def read_json_me(params_file):
-        import json
-        json_file = open(params_file, 'rt')
-        data = json.load(json_file)
-        te = data['EchoTime']
-        json_file.close()
-        return te
-    def read_json_se(params_files):
-        import json
-        json_file = open(params_files[0], 'rt')
-        data = json.load(json_file)
-        B0 = data['MagneticFieldStrength']
-        json_file.close()
-        return B0
-    mn_json_params = MapNode(
-        interface=Function(
-            input_names=['params_file'],
-            output_names=['TE'],
-            function=read_json_me
-        ),
-        iterfield=['params_file'],
-        name='func_read-json-me'
-    )
-    wf.connect([
-        (n_inputs, mn_json_params, [('params_files', 'params_file')])
-    ])
-    n_json_params = Node(
-        interface=Function(
-            input_names=['params_files'],
-            output_names=['B0'],
-            function=read_json_se
-        ),
-        iterfield=['params_file'],
-        name='func_read-json-se'
-    )
-    wf.connect([
-        (n_inputs, n_json_params, [('params_files', 'params_files')])
-    ])
-
-    # read voxel size 'vsz' from nifti file
-    def read_nii(nii_file):
-        import nibabel as nib
-        if isinstance(nii_file, list): nii_file = nii_file[0]
-        nii = nib.load(nii_file)
-        return str(nii.header.get_zooms()).replace(" ", "")
-    n_nii_params = Node(
-        interface=Function(
-            input_names=['nii_file'],
-            output_names=['vsz'],
-            function=read_nii
-        ),
-        name='nibabel_read-nii'
-    )
-    wf.connect([
-        (n_inputs, n_nii_params, [('phase', 'nii_file')])
-    ])
-
-    # scale phase data
-    mn_phase_scaled = MapNode(
-        interface=process_phase.ScalePhaseInterface(),
-        iterfield=['phase'],
-        name='nibabel_numpy_scale-phase'
-        # outputs : 'out_file'
-    )
-    wf.connect([
-        (n_inputs, mn_phase_scaled, [('phase', 'phase')])
-    ])    
-
-    # reorient to canonical
-    def as_closest_canonical(phase, magnitude=None, mask=None):
-        import os
-        import nibabel as nib
-        out_phase = os.path.abspath(f"{os.path.split(phase)[-1].split('.')[0]}_canonical.nii")
-        out_mag = os.path.abspath(f"{os.path.split(magnitude)[-1].split('.')[0]}_canonical.nii") if magnitude else None
-        out_mask = os.path.abspath(f"{os.path.split(mask)[-1].split('.')[0]}_canonical.nii") if mask else None
-        if nib.aff2axcodes(nib.load(phase).affine) == ('R', 'A', 'S'): return phase, magnitude, mask
-        nib.save(nib.as_closest_canonical(nib.load(phase)), out_phase)
-        if magnitude: nib.save(nib.as_closest_canonical(nib.load(magnitude)), out_mag)
-        if mask: nib.save(nib.as_closest_canonical(nib.load(mask)), out_mask)
-        return out_phase, out_mag, out_mask
-    mn_inputs_canonical = MapNode(
-        interface=Function(
-            input_names=['phase'] + (['magnitude'] if magnitude_files else []) + (['mask'] if mask_files else []),
-            output_names=['phase', 'magnitude', 'mask'],
-            function=as_closest_canonical
+    # scale phase data, reorient to canonical and resample to axial
+    mn_inputs_preprocessed = MapNode(
+        interface=preprocess.PreprocessInterface(
+            obliquity_threshold=999 if run_args.obliquity_threshold == -1 else run_args.obliquity_threshold,
+            float_dtype=run_args.float_dtype
         ),
         iterfield=['phase'] + (['magnitude'] if magnitude_files else []) + (['mask'] if mask_files else []),
-        name='nibabel_as-canonical'
+        name='nibabel_numpy_nilearn_preprocess'
     )
-    wf.connect([
-        (mn_phase_scaled, mn_inputs_canonical, [('phase_scaled', 'phase')])
-    ])
-    if magnitude_files:
-        wf.connect([
-            (n_inputs, mn_inputs_canonical, [('magnitude', 'magnitude')]),
-        ])
-    if mask_files:
-        wf.connect([
-            (n_inputs, mn_inputs_canonical, [('mask', 'mask')]),
-        ])
-    
-    # resample to axial
     n_inputs_resampled = Node(
         interface=IdentityInterface(
             fields=['phase', 'magnitude', 'mask']
         ),
         name='nipype_inputs-resampled'
     )
+    wf.connect([
+        (n_inputs, mn_inputs_preprocessed, [('phase', 'phase')]),
+        (mn_inputs_preprocessed, n_inputs_resampled, [('phase', 'phase')])
+    ])
     if magnitude_files:
-        mn_resample_inputs = MapNode(
-            interface=sampling.AxialSamplingInterface(
-                obliquity_threshold=999 if run_args.obliquity_threshold == -1 else run_args.obliquity_threshold
-            ),
-            iterfield=['magnitude', 'phase', 'mask'] if mask_files else ['magnitude', 'phase'],
-            name='nibabel_numpy_nilearn_axial-resampling'
-        )
         wf.connect([
-            (mn_inputs_canonical, mn_resample_inputs, [('magnitude', 'magnitude')]),
-            (mn_inputs_canonical, mn_resample_inputs, [('phase', 'phase')]),
-            (mn_resample_inputs, n_inputs_resampled, [('magnitude', 'magnitude')]),
-            (mn_resample_inputs, n_inputs_resampled, [('phase', 'phase')])
+            (n_inputs, mn_inputs_preprocessed, [('magnitude', 'magnitude')]),
+            (mn_inputs_preprocessed, n_inputs_resampled, [('magnitude', 'magnitude')])
         ])
-        if mask_files:
-            wf.connect([
-                (mn_inputs_canonical, mn_resample_inputs, [('mask', 'mask')]),
-                (mn_resample_inputs, n_inputs_resampled, [('mask', 'mask')])
-            ])
-    else:
+    if mask_files:
         wf.connect([
-            (mn_inputs_canonical, n_inputs_resampled, [('phase', 'phase')])
+            (n_inputs, mn_inputs_preprocessed, [('mask', 'mask')]),
+            (mn_inputs_preprocessed, n_inputs_resampled, [('mask', 'mask')])
         ])
-        if mask_files:
-            wf.connect([
-                (mn_inputs_canonical, n_inputs_resampled, [('mask', 'mask')])
-            ])
 
     # run homogeneity filter if necessary
     if run_args.inhomogeneity_correction:
@@ -322,11 +261,11 @@ def init_run_workflow(run_args, subject, session, run):
     if run_args.combine_phase:
         # romeo for phase combination
         n_romeo_combine = Node(
-            interface=romeo.RomeoB0Interface(),
+            interface=romeo.RomeoB0Interface(float_dtype=run_args.float_dtype),
             name='mrt_romeo_combine',
         )
+        n_romeo_combine.inputs.TE = echo_times
         wf.connect([
-            (mn_json_params, n_romeo_combine, [('TE', 'TE')]),
             (n_inputs_resampled, n_romeo_combine, [('phase', 'phase')]),
             (n_inputs_resampled, n_romeo_combine, [('magnitude', 'magnitude')]),
             (n_romeo_combine, n_inputs_combine, [('frequency', 'frequency')]),
@@ -364,8 +303,8 @@ def init_run_workflow(run_args, subject, session, run):
             ])
 
     else:
+        n_inputs_combine.inputs.TE = echo_times
         wf.connect([
-            (mn_json_params, n_inputs_combine, [('TE', 'TE')]),
             (n_inputs_resampled, n_inputs_combine, [('mask', 'mask')])
         ])
         if run_args.inhomogeneity_correction:
@@ -423,14 +362,14 @@ def init_run_workflow(run_args, subject, session, run):
         (n_inputs_combine, wf_qsm, [('frequency', 'qsm_inputs.frequency')]),
         (n_inputs_combine, wf_qsm, [('magnitude', 'qsm_inputs.magnitude')]),
         (wf_masking, wf_qsm, [('masking_outputs.mask', 'qsm_inputs.mask')]),
-        (n_inputs_combine, wf_qsm, [('TE', 'qsm_inputs.TE')]),
-        (n_json_params, wf_qsm, [('B0', 'qsm_inputs.B0')]),
-        (n_nii_params, wf_qsm, [('vsz', 'qsm_inputs.vsz')])
+        (n_inputs_combine, wf_qsm, [('TE', 'qsm_inputs.TE')])
     ])
     wf_qsm.get_node('qsm_inputs').inputs.b0_direction = "(0,0,1)"
+    wf_qsm.get_node('qsm_inputs').inputs.B0 = B0
+    wf_qsm.get_node('qsm_inputs').inputs.vsz = vsz
     
     n_qsm_average = Node(
-        interface=nonzeroaverage.NonzeroAverageInterface(),
+        interface=nonzeroaverage.NonzeroAverageInterface(float_dtype=run_args.float_dtype),
         name="nibabel_numpy_qsm-average"
     )
     wf.connect([
@@ -481,15 +420,15 @@ def init_run_workflow(run_args, subject, session, run):
             (n_inputs_combine, wf_qsm_intermediate, [('frequency', 'qsm_inputs.frequency')]),
             (n_inputs_combine, wf_qsm_intermediate, [('magnitude', 'qsm_inputs.magnitude')]),
             (n_inputs_combine, wf_qsm_intermediate, [('TE', 'qsm_inputs.TE')]),
-            (n_json_params, wf_qsm_intermediate, [('B0', 'qsm_inputs.B0')]),
-            (n_nii_params, wf_qsm_intermediate, [('vsz', 'qsm_inputs.vsz')]),
             (wf_masking_intermediate, wf_qsm_intermediate, [('masking_outputs.mask', 'qsm_inputs.mask')])
         ])
         wf_qsm_intermediate.get_node('qsm_inputs').inputs.b0_direction = "(0,0,1)"
+        wf_qsm_intermediate.get_node('qsm_inputs').inputs.B0 = B0
+        wf_qsm_intermediate.get_node('qsm_inputs').inputs.vsz = vsz
                 
         # two-pass combination
         mn_qsm_twopass = MapNode(
-            interface=twopass.TwopassNiftiInterface(),
+            interface=twopass.TwopassNiftiInterface(float_dtype=run_args.float_dtype),
             name='numpy_nibabel_twopass',
             iterfield=['in_file1', 'in_file2', 'mask']
         )
@@ -501,7 +440,7 @@ def init_run_workflow(run_args, subject, session, run):
 
         # averaging
         n_qsm_twopass_average = Node(
-            interface=nonzeroaverage.NonzeroAverageInterface(),
+            interface=nonzeroaverage.NonzeroAverageInterface(float_dtype=run_args.float_dtype),
             name="nibabel_numpy_twopass-average"
         )
         wf.connect([
@@ -860,6 +799,33 @@ def parse_args(args, return_run_command=False):
              'CPUs is used.'
     )
 
+    parser.add_argument(
+        '--float_dtype',
+        choices=FLOAT_DTYPES,
+        default=None,
+        help='Floating-point precision used for continuous data processed by the Python-based steps of '+
+             'the pipeline; masks are always stored as uint8. By default, float32 is used.'
+    )
+
+    parser.add_argument(
+        '--decompress_inputs',
+        action='store_true',
+        default=None,
+        help='Decompresses each gzipped input once into a cache within the output directory, so that '+
+             'pipeline steps read uncompressed copies. Inputs of all runs are decompressed in parallel before the '+
+             'pipeline starts. With MultiProc, the cache is removed once the pipeline finishes or fails; with --pbs '+
+             'or --slurm it is kept for the submitted jobs and should be removed once they complete.'
+    )
+
+    parser.add_argument(
+        '--compress_outputs',
+        action='store_true',
+        default=None,
+        help='Gzip-compresses the final NIfTI outputs once the pipeline completes. Intermediate files '+
+             'are always written uncompressed. Only supported when running locally with MultiProc; with --pbs or '+
+             '--slurm the pipeline returns once jobs are submitted, so outputs are left uncompressed.'
+    )
+
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -1368,6 +1334,10 @@ def process_args(args):
     # set number of concurrent processes to run depending on available resources
     if not args.n_procs:
         args.n_procs = int(os.environ["NCPUS"] if "NCPUS" in os.environ else os.cpu_count())
+
+    # set floating-point precision for python-based processing
+    if not args.float_dtype:
+        args.float_dtype = FLOAT_DTYPES[0]
     
 
     # get rough estimate of available memory
@@ -1521,26 +1491,46 @@ if __name__ == "__main__":
 
     # run workflow
     if not args.dry:
-        if args.slurm[0] is not None:
-            wf.run(
-                plugin='SLURM',
-                plugin_args=gen_plugin_args(slurm_account=args.slurm[0], slurm_partition=args.slurm[1])
-            )
-        if args.pbs:
-            wf.run(
-                plugin='PBSGraph',
-                plugin_args=gen_plugin_args(pbs_account=args.pbs)
-            )
-        else:
-            logger.log(LogLevel.INFO.value, f"Running using MultiProc plugin with n_procs={args.n_procs}")
-            plugin_args = { 'n_procs' : args.n_procs }
-            if os.environ.get("PBS_JOBID"):
-                jobid = os.environ.get("PBS_JOBID").split(".")[0]
-                plugin_args['memory_gb'] = float(sys_cmd(f"qstat -f {jobid} | grep Resource_List.mem", print_output=False, print_command=False).split(" = ")[1].split("gb")[0])
-            wf.run(
-                plugin='MultiProc',
-                plugin_args=plugin_args
-            )
+        # use uncompressed copies of gzipped inputs if requested
+        if args.decompress_inputs:
+            logger.log(LogLevel.INFO.value, f"Decompressing inputs to {get_input_cache_dir(args)}...")
+            decompress_workflow_inputs(wf, args)
+
+        try:
+            if args.slurm[0] is not None:
+                wf.run(
+                    plugin='SLURM',
+                    plugin_args=gen_plugin_args(slurm_account=args.slurm[0], slurm_partition=args.slurm[1])
+                )
+            if args.pbs:
+                wf.run(
+                    plugin='PBSGraph',
+                    plugin_args=gen_plugin_args(pbs_account=args.pbs)
+                )
+            else:
+                logger.log(LogLevel.INFO.value, f"Running using MultiProc plugin with n_procs={args.n_procs}")
+                plugin_args = { 'n_procs' : args.n_procs }
+                if os.environ.get("PBS_JOBID"):
+                    jobid = os.environ.get("PBS_JOBID").split(".")[0]
+                    plugin_args['memory_gb'] = float(sys_cmd(f"qstat -f {jobid} | grep Resource_List.mem", print_output=False, print_command=False).split(" = ")[1].split("gb")[0])
+                wf.run(
+                    plugin='MultiProc',
+                    plugin_args=plugin_args
+                )
+        finally:
+            # remove decompressed inputs, including when the workflow fails
+            # graph plugins return once jobs are submitted, so the cache is kept for the jobs that read it
+            if args.decompress_inputs and args.multiproc:
+                shutil.rmtree(get_input_cache_dir(args), ignore_errors=True)
+            elif args.decompress_inputs:
+                logger.log(LogLevel.INFO.value, f"Decompressed inputs are kept in {get_input_cache_dir(args)} for the submitted jobs; remove it once they complete.")
+
+        # compress final outputs if requested (graph plugins return before the outputs are written)
+        if args.compress_outputs and args.multiproc:
+            logger.log(LogLevel.INFO.value, f"Compressing outputs in {args.output_dir}...")
+            compress_outputs(args.output_dir)
+        elif args.compress_outputs:
+            logger.log(LogLevel.WARNING.value, "--compress_outputs is only supported with MultiProc; outputs were not compressed.")
 
     script_exit()
 
@@ -0,0 +1,136 @@
+import os
+import json
+import fnmatch
+import glob as _glob
+
+# in-memory index of a BIDS directory tree, used to resolve glob patterns without repeatedly listing directories
+# directories are keyed by their path relative to the root; reloading from a cache only re-lists directories
+# whose modification time has changed
+
+class BidsIndex:
+
+    def __init__(self, root, dirs=None):
+        self.root = os.path.abspath(root)
+        self.dirs = dirs if dirs is not None else {}
+
+    def _ancestors(self, rel_dir):
+        # real paths of the directories above rel_dir, back to the root
+        ancestors = set()
+        while rel_dir:
+            rel_dir = os.path.dirname(rel_dir)
+            ancestors.add(os.path.realpath(os.path.join(self.root, rel_dir) if rel_dir else self.root))
+        return ancestors
+
+    def _scan(self, rel_dir, ancestors):
+        # lists a directory and any subdirectories not already in the index
+        # symbolic links are followed as glob does; only links back to a directory on the current descent are skipped
+        full_dir = os.path.join(self.root, rel_dir) if rel_dir else self.root
+        real_dir = os.path.realpath(full_dir)
+        if real_dir in ancestors:
+            return
+        files = []
+        subdirs = []
+        try:
+            mtime_ns = os.stat(full_dir).st_mtime_ns
+            with os.scandir(full_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        else:
+                            files.append(entry.name)
+                    except OSError:
+                        files.append(entry.name)
+        except OSError:
+            self.dirs.pop(rel_dir, None)
+            return
+        self.dirs[rel_dir] = { 'mtime_ns' : mtime_ns, 'files' : sorted(files), 'dirs' : sorted(subdirs) }
+        for subdir in sorted(subdirs):
+            rel_subdir = os.path.join(rel_dir, subdir) if rel_dir else subdir
+            if rel_subdir not in self.dirs:
+                self._scan(rel_subdir, ancestors | {real_dir})
+
+    def scan(self):
+        # lists the whole tree in a single walk
+        self.dirs = {}
+        self._scan('', set())
+        return self
+
+    def refresh(self):
+        # re-lists only directories that changed since they were indexed, and drops any that were removed
+        for rel_dir in list(self.dirs.keys()):
+            if rel_dir not in self.dirs: continue
+            full_dir = os.path.join(self.root, rel_dir) if rel_dir else self.root
+            try:
+                mtime_ns = os.stat(full_dir).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if mtime_ns != self.dirs[rel_dir]['mtime_ns']:
+                old_subdirs = self.dirs[rel_dir]['dirs']
+                self._scan(rel_dir, self._ancestors(rel_dir))
+                new_subdirs = self.dirs[rel_dir]['dirs'] if rel_dir in self.dirs else []
+                for subdir in old_subdirs:
+                    if subdir not in new_subdirs:
+                        self._remove(os.path.join(rel_dir, subdir) if rel_dir else subdir)
+        if '' not in self.dirs:
+            self._scan('', set())
+        return self
+
+    def _remove(self, rel_dir):
+        for key in [key for key in self.dirs if key == rel_dir or key.startswith(rel_dir + os.sep)]:
+            del self.dirs[key]
+
+    def glob(self, pattern):
+        # equivalent to glob.glob(pattern) for absolute patterns within the root (or patterns relative to it)
+        pattern = os.path.abspath(os.path.join(self.root, pattern))
+        if os.path.commonpath([pattern, self.root]) != self.root:
+            return _glob.glob(pattern)
+        components = os.path.relpath(pattern, self.root).split(os.sep)
+        if components == ['.']:
+            return [self.root]
+        rel_paths = ['']
+        for i, component in enumerate(components):
+            is_last = i == len(components) - 1
+            matches = []
+            for rel_dir in rel_paths:
+                entry = self.dirs.get(rel_dir)
+                if entry is None: continue
+                names = entry['dirs'] + entry['files'] if is_last else entry['dirs']
+                if _glob.has_magic(component):
+                    # as with glob, hidden names are only matched by patterns starting with '.'
+                    if not component.startswith('.'):
+                        names = [name for name in names if not name.startswith('.')]
+                    names = fnmatch.filter(names, component)
+                elif component not in names:
+                    names = []
+                else:
+                    names = [component]
+                matches.extend(os.path.join(rel_dir, name) if rel_dir else name for name in names)
+            rel_paths = matches
+        return [os.path.join(self.root, rel_path) for rel_path in rel_paths]
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as index_file:
+            json.dump({ 'root' : self.root, 'dirs' : self.dirs }, index_file)
+
+def load_bids_index(root, cache_path=None):
+    # loads the index from cache_path if it was built for the same root, refreshing it; otherwise scans the tree
+    root = os.path.abspath(root)
+    index = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, encoding='utf-8') as index_file:
+                cached = json.load(index_file)
+            if cached['root'] == root:
+                index = BidsIndex(root, cached['dirs']).refresh()
+        except (OSError, ValueError, KeyError):
+            index = None
+    if index is None:
+        index = BidsIndex(root).scan()
+    if cache_path:
+        try:
+            index.save(cache_path)
+        except OSError:
+            pass
+    return index
+
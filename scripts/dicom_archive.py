@@ -0,0 +1,111 @@
+import io
+import os
+import tarfile
+import zipfile
+
+# access to DICOMs stored in zip or tar archives without extracting them
+# members are addressed by locations of the form <archive_path>::<member_name>
+# compressed tar archives can only be read sequentially, so their members are processed in a single streaming
+# pass (stream_tar_members) rather than accessed by name
+
+ARCHIVE_SEPARATOR = "::"
+ZIP_EXTENSIONS = ['.zip']
+TAR_EXTENSIONS = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+
+# archives opened by the current process, reused across members
+_open_archives = {}
+_tar_members = {}
+
+# member names per archive path, kept across close_archives() while the archive's size and mtime are unchanged
+_member_lists = {}
+
+# contents of the tar member currently being streamed, served by open_member()
+_streamed_members = {}
+
+def is_zip(path):
+    return any(path.lower().endswith(ext) for ext in ZIP_EXTENSIONS)
+
+def is_tar(path):
+    return any(path.lower().endswith(ext) for ext in TAR_EXTENSIONS)
+
+def is_archive(path):
+    return is_zip(path) or is_tar(path)
+
+def is_archive_location(location):
+    return ARCHIVE_SEPARATOR in location
+
+def make_archive_location(archive_path, member_name):
+    return f"{archive_path}{ARCHIVE_SEPARATOR}{member_name}"
+
+def split_archive_location(location):
+    # returns (archive_path, member_name); member_name is None for plain files
+    if not is_archive_location(location):
+        return location, None
+    archive_path, member_name = location.split(ARCHIVE_SEPARATOR, 1)
+    return archive_path, member_name
+
+def get_archive(archive_path):
+    if archive_path not in _open_archives:
+        if is_zip(archive_path):
+            _open_archives[archive_path] = zipfile.ZipFile(archive_path)
+        else:
+            _open_archives[archive_path] = tarfile.open(archive_path, 'r:*')
+            _tar_members[archive_path] = { member.name : member for member in _open_archives[archive_path].getmembers() }
+    return _open_archives[archive_path]
+
+def close_archives():
+    for archive in _open_archives.values():
+        archive.close()
+    _open_archives.clear()
+    _tar_members.clear()
+
+def list_archive_members(archive_path):
+    # returns the names of regular files in the archive, or an empty list if it cannot be read (e.g. still being written)
+    try:
+        stat = os.stat(archive_path)
+    except OSError:
+        return []
+    stat = (stat.st_size, stat.st_mtime_ns)
+    if archive_path in _member_lists and _member_lists[archive_path][0] == stat:
+        return list(_member_lists[archive_path][1])
+    try:
+        if is_zip(archive_path):
+            with zipfile.ZipFile(archive_path) as archive:
+                names = [info.filename for info in archive.infolist() if not info.is_dir()]
+        else:
+            with tarfile.open(archive_path, 'r|*') as archive:
+                names = [member.name for member in archive if member.isfile()]
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError):
+        return []
+    _member_lists[archive_path] = (stat, names)
+    return list(names)
+
+def stream_tar_members(archive_path, member_names):
+    # reads the archive once in order, yielding each requested member name while open_member() serves its contents
+    wanted = set(member_names)
+    with tarfile.open(archive_path, 'r|*') as archive:
+        for member in archive:
+            if not member.isfile() or member.name not in wanted:
+                continue
+            location = make_archive_location(archive_path, member.name)
+            _streamed_members[location] = archive.extractfile(member).read()
+            try:
+                yield member.name
+            finally:
+                _streamed_members.pop(location, None)
+
+def open_member(location):
+    # returns a readable file object for the archive member; zip members can be read from any process
+    # concurrently, whereas tar members should be read within stream_tar_members() (random access is a fallback)
+    if location in _streamed_members:
+        return io.BytesIO(_streamed_members[location])
+    archive_path, member_name = split_archive_location(location)
+    archive = get_archive(archive_path)
+    if isinstance(archive, zipfile.ZipFile):
+        return archive.open(member_name)
+    return archive.extractfile(_tar_members[archive_path][member_name])
+
+def read_member_bytes(location, size=-1):
+    with open_member(location) as f:
+        return f.read(size)
+
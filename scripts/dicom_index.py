@@ -0,0 +1,83 @@
+import os
+import json
+import sqlite3
+
+from scripts.dicom_archive import split_archive_location
+
+# persistent index of parsed DICOM headers keyed by path, size and modification time
+# used by run_0_dicomSort.py so that reruns only parse new or changed files
+
+def open_index(index_path):
+    conn = sqlite3.connect(index_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS dicoms ("
+        "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+        "patient_id TEXT, study_instance_uid TEXT, series_instance_uid TEXT, sop_instance_uid TEXT, "
+        "header TEXT, out_path TEXT)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS dicoms_sop_instance_uid ON dicoms (sop_instance_uid)")
+    conn.commit()
+    return conn
+
+def get_file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def get_cached_headers(conn, paths, stats):
+    # returns {path: (header, out_path)} for files whose size and mtime are unchanged since they were indexed
+    cached = {}
+    cursor = conn.cursor()
+    for path, stat in zip(paths, stats):
+        if stat is None: continue
+        row = cursor.execute("SELECT size, mtime_ns, header, out_path FROM dicoms WHERE path = ?", (path,)).fetchone()
+        if row and (row[0], row[1]) == tuple(stat):
+            cached[path] = (json.loads(row[2]), row[3])
+    return cached
+
+def update_headers(conn, paths, stats, headers, out_paths=None):
+    out_paths = out_paths or [None for path in paths]
+    conn.executemany(
+        "INSERT OR REPLACE INTO dicoms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                path, stat[0], stat[1],
+                header['patientID'], header['studyInstanceUID'], header['seriesInstanceUID'], header['sopInstanceUID'],
+                json.dumps(header), out_path
+            )
+            for path, stat, header, out_path in zip(paths, stats, headers, out_paths)
+            if stat is not None and header is not None
+        ]
+    )
+    conn.commit()
+
+def find_sorted_duplicate(conn, sop_instance_uid, path):
+    # returns another existing source file already sorted with the same SOPInstanceUID, if any
+    # rows for sorted files themselves (path == out_path) and for the source that path was sorted from are ignored
+    rows = conn.execute(
+        "SELECT path, out_path FROM dicoms WHERE sop_instance_uid = ? AND out_path IS NOT NULL", (sop_instance_uid,)
+    ).fetchall()
+    for other_path, out_path in rows:
+        if path in [other_path, out_path] or other_path == out_path:
+            continue
+        if os.path.exists(split_archive_location(other_path)[0]) and os.path.exists(out_path):
+            return other_path
+    return None
+
+def set_out_paths(conn, paths, out_paths):
+    conn.executemany("UPDATE dicoms SET out_path = ? WHERE path = ?", list(zip(out_paths, paths)))
+    conn.commit()
+
+def prune_index(conn, keep_paths):
+    # remove entries for files (or the archives holding them) that no longer exist
+    keep_paths = set(keep_paths)
+    stale = [
+        (path,) for (path,) in conn.execute("SELECT path FROM dicoms").fetchall()
+        if path not in keep_paths and not os.path.exists(split_archive_location(path)[0])
+    ]
+    conn.executemany("DELETE FROM dicoms WHERE path = ?", stale)
+    conn.commit()
+    return len(stale)
+
@@ -0,0 +1,59 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import binary_erosion, binary_dilation, binary_fill_holes, correlate1d, distance_transform_cdt, gaussian_filter1d
+
+# morphology on boolean masks
+# erosion and dilation by n steps of the 6-connected structuring element (scipy's default) are equivalent to
+# thresholding the city-block distance to the nearest background/foreground voxel, which is computed in two
+# passes over the volume regardless of n; a single step is done directly as it is cheaper than the transform
+
+def erode(mask, iterations=1):
+    # equivalent to scipy.ndimage.binary_erosion(mask, iterations=iterations) (voxels outside the volume are background)
+    mask = np.asarray(mask, dtype=bool)
+    if iterations <= 0: return mask.copy()
+    if iterations == 1: return binary_erosion(mask)
+    padded = np.pad(mask, 1, mode='constant', constant_values=False)
+    distance = distance_transform_cdt(padded, metric='taxicab')
+    return distance[(slice(1, -1),) * mask.ndim] > iterations
+
+def dilate(mask, iterations=1):
+    # equivalent to scipy.ndimage.binary_dilation(mask, iterations=iterations)
+    mask = np.asarray(mask, dtype=bool)
+    if iterations <= 0 or not mask.any(): return mask.copy()
+    if iterations == 1: return binary_dilation(mask)
+    return distance_transform_cdt(~mask, metric='taxicab') <= iterations
+
+def opening(mask, iterations=1):
+    # equivalent to scipy.ndimage.binary_opening(mask, iterations=iterations)
+    return dilate(erode(mask, iterations), iterations)
+
+def fill_holes(mask):
+    return binary_fill_holes(np.asarray(mask, dtype=bool))
+
+def count_neighbours(mask):
+    # number of foreground voxels in each voxel's 3x3x3 neighbourhood (excluding itself) as three 1D box sums
+    counts = np.asarray(mask, dtype=np.uint8)
+    for axis in range(counts.ndim):
+        counts = correlate1d(counts, np.ones(3, dtype=np.uint8), axis=axis, mode='constant', cval=0)
+    counts -= np.asarray(mask, dtype=np.uint8)
+    return counts
+
+def smooth(mask, sigma, truncate=4.0, n_threads=1):
+    # equivalent to scipy.ndimage.gaussian_filter(mask * 1.0, sigma, truncate=truncate) in float32
+    # the filter is applied one axis at a time; each pass is split into chunks along another axis that are
+    # filtered concurrently (scipy releases the GIL)
+    smoothed = np.asarray(mask, dtype=np.float32)
+    sigmas = np.broadcast_to(sigma, (smoothed.ndim,))
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        for axis, axis_sigma in enumerate(sigmas):
+            if axis_sigma <= 0: continue
+            chunk_axis = max((a for a in range(smoothed.ndim) if a != axis), key=lambda a: smoothed.shape[a])
+            out = np.empty_like(smoothed)
+            def filter_chunk(bounds):
+                chunk = [slice(None)] * smoothed.ndim
+                chunk[chunk_axis] = slice(*bounds)
+                gaussian_filter1d(smoothed[tuple(chunk)], axis_sigma, axis=axis, truncate=truncate, output=out[tuple(chunk)])
+            edges = np.linspace(0, smoothed.shape[chunk_axis], min(max(1, n_threads), smoothed.shape[chunk_axis]) + 1).astype(int)
+            list(executor.map(filter_chunk, zip(edges[:-1], edges[1:])))
+            smoothed = out
+    return smoothed
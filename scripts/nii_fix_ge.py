@@ -2,6 +2,7 @@
 
 import nibabel as nib
 import numpy as np
+import scipy.fft
 import argparse
 import os
 import json
@@ -12,7 +13,21 @@ def load_json(path):
     f.close()
     return j
 
-def fix_ge_polar(mag_path, phase_path, delete_originals=True):
+def correct_ge_complex(complex_data, workers=-1):
+    # applies fftshift(ifftn(fftshift(fftshift(fftshift(fftn(fftshift(x))), axes=2)))) in place where possible
+    # when every dimension is even (or 1), the shifts cancel except along axis 2, and a half-length shift in
+    # k-space along axis 2 is equivalent to modulating the image by (-1)^(n2 - N2//2)
+    if all(dim % 2 == 0 or dim == 1 for dim in complex_data.shape):
+        num_slices = complex_data.shape[2]
+        sign = np.where((np.arange(num_slices) - num_slices // 2) % 2 == 0, 1, -1).astype(np.float32)
+        complex_data *= sign.reshape([1, 1, num_slices] + [1] * (complex_data.ndim - 3))
+        return complex_data
+
+    # otherwise, perform the k-space round trip in single precision using multithreaded FFTs
+    complex_data_kspace = scipy.fft.fftshift(scipy.fft.fftshift(scipy.fft.fftn(scipy.fft.fftshift(complex_data), workers=workers, overwrite_x=True)), axes=2)
+    return scipy.fft.fftshift(scipy.fft.ifftn(scipy.fft.fftshift(complex_data_kspace), workers=workers, overwrite_x=True))
+
+def fix_ge_polar(mag_path, phase_path, delete_originals=True, workers=-1):
 
     # ensure paths are absolute
     mag_path = os.path.abspath(mag_path)
@@ -20,21 +35,24 @@ def fix_ge_polar(mag_path, phase_path, delete_originals=True):
 
     # load magnitude data
     mag_nii = nib.load(mag_path)
-    mag_data = mag_nii.get_fdata()
+    mag_data = mag_nii.get_fdata(dtype=np.float32)
 
     # load phase data
     phase_nii = nib.load(phase_path)
-    phase_data = phase_nii.get_fdata()
+    phase_data = phase_nii.get_fdata(dtype=np.float32)
 
     # compute complex result in the image domain
-    phase_data_scaled = phase_data / 4096 * np.pi
-    complex_data_image = mag_data * (np.cos(phase_data_scaled) + 1j * np.sin(phase_data_scaled))
-    scaling = np.sqrt(complex_data_image.size)
-    complex_data_kspace = np.fft.fftshift (np.fft.fftshift (np.fft.fftn(  np.fft.fftshift(complex_data_image))), axes=2) / scaling
-    complex_data_correct_image = np.fft.fftshift(np.fft.ifftn(np.fft.fftshift(complex_data_kspace))) * scaling        
+    phase_data *= np.float32(np.pi / 4096)
+    complex_data_image = np.empty(mag_data.shape, dtype=np.complex64)
+    complex_data_image.real = np.cos(phase_data)
+    complex_data_image.imag = np.sin(phase_data)
+    complex_data_image *= mag_data
+    del mag_data, phase_data
+    complex_data_correct_image = correct_ge_complex(complex_data_image, workers)
 
     # compute corrected phase image
     phase_corr_data = np.angle(complex_data_correct_image)
+    del complex_data_image, complex_data_correct_image
 
     # create nifti image
     phase_nii.header.set_data_dtype(np.float16)
@@ -53,7 +71,7 @@ def fix_ge_polar(mag_path, phase_path, delete_originals=True):
         os.rename(phase_corr_path, phase_path)
 
 
-def fix_ge_complex(real_path, imag_path, delete_originals=False):
+def fix_ge_complex(real_path, imag_path, delete_originals=False, workers=-1):
 
     # ensure paths are absolute
     real_path = os.path.abspath(real_path)
@@ -61,21 +79,20 @@ def fix_ge_complex(real_path, imag_path, delete_originals=False):
 
     # load real data
     real_nii = nib.load(real_path)
-    real_data = real_nii.get_fdata()
     
     # load imaginary data
     imag_nii = nib.load(imag_path)
-    imag_data = imag_nii.get_fdata()
 
     # compute complex result in the image domain
-    complex_data_image = real_data + 1j * imag_data
-    scaling = np.sqrt(complex_data_image.size)
-    complex_data_kspace = np.fft.fftshift(np.fft.fftshift (np.fft.fftn(  np.fft.fftshift(complex_data_image))), axes=2) / scaling
-    complex_data_correct_image = np.fft.fftshift(np.fft.ifftn(np.fft.fftshift(complex_data_kspace))) * scaling        
+    complex_data_image = np.empty(real_nii.shape, dtype=np.complex64)
+    complex_data_image.real = real_nii.get_fdata(dtype=np.float32)
+    complex_data_image.imag = imag_nii.get_fdata(dtype=np.float32)
+    complex_data_correct_image = correct_ge_complex(complex_data_image, workers)
 
     # compute magnitude and phase of complex image
     phase_data = np.angle(complex_data_correct_image)
     mag_data = np.abs(complex_data_correct_image)
+    del complex_data_image, complex_data_correct_image
 
     # create nifti images
     mag_nii = nib.Nifti1Image(mag_data, real_nii.affine, real_nii.header)
@@ -0,0 +1,34 @@
+import numpy as np
+import nibabel as nib
+from scripts.qsmxt_io import load_nii
+
+# pipeline-wide dtype policy for NIfTI data loaded and saved by the python interfaces
+# continuous data uses the given float dtype (from run_2_qsm.py --float_dtype, passed to each interface as its
+# float_dtype input so that it is part of the node hash), defaulting to float32; masks are stored as uint8
+
+FLOAT_DTYPES = ['float32', 'float64']
+MASK_DTYPE = np.uint8
+
+def get_float_dtype(float_dtype=None):
+    return np.dtype(float_dtype if float_dtype in FLOAT_DTYPES else FLOAT_DTYPES[0])
+
+def load_float(nii, float_dtype=None):
+    # like get_fdata(), but in the policy dtype rather than float64
+    if isinstance(nii, str): nii = load_nii(nii)
+    return nii.get_fdata(dtype=get_float_dtype(float_dtype))
+
+def load_mask(nii):
+    if isinstance(nii, str): nii = load_nii(nii)
+    return np.asanyarray(nii.dataobj) != 0
+
+def float_nii(data, nii_like, affine=None, float_dtype=None):
+    # creates an image in the policy dtype using the header of nii_like
+    float_dtype = get_float_dtype(float_dtype)
+    header = nii_like.header.copy()
+    header.set_data_dtype(float_dtype)
+    return nib.Nifti1Image(np.asarray(data, dtype=float_dtype), affine=nii_like.affine if affine is None else affine, header=header)
+
+def mask_nii(data, nii_like, affine=None):
+    header = nii_like.header.copy()
+    header.set_data_dtype(MASK_DTYPE)
+    return nib.Nifti1Image(np.asarray(data, dtype=MASK_DTYPE), affine=nii_like.affine if affine is None else affine, header=header)
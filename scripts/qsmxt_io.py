@@ -0,0 +1,126 @@
+import os
+import gzip
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+
+# shared NIfTI I/O for the python interfaces
+# intermediates are always written uncompressed so that later nodes can memory-map them rather than
+# decompress them; only final outputs are (optionally) gzipped by compress_outputs()
+
+def load_nii(path):
+    # uncompressed images are memory-mapped copy-on-write, so slices and in-place edits never touch the file
+    return nib.load(path, mmap='c')
+
+def uncompressed_path(path):
+    if path.endswith('.nii.gz'): return path[:-len('.gz')]
+    if path.endswith('.nii'): return path
+    return f"{os.path.splitext(path)[0]}.nii"
+
+def _fits_without_scaling(data, out_dtype):
+    # true if data can be stored in out_dtype as-is, i.e. without nibabel computing a scale factor
+    if np.issubdtype(out_dtype, np.floating):
+        return True
+    if not (np.issubdtype(data.dtype, np.integer) or data.dtype == bool):
+        return False
+    if data.size == 0:
+        return True
+    info = np.iinfo(out_dtype)
+    return info.min <= data.min() and data.max() <= info.max
+
+def save_nii(img, filename):
+    # writes img uncompressed, filling the data block through a memory map, and returns the path written;
+    # a .nii.gz filename is written as .nii, so callers must use the returned path
+    # images that need integer scaling are left to nibabel
+    filename = uncompressed_path(filename)
+    if type(img) != nib.Nifti1Image:
+        nib.save(img, filename)
+        return filename
+    data = np.asanyarray(img.dataobj)
+    img.update_header()
+    header = img.header.copy()
+    header.set_data_shape(data.shape)
+    out_dtype = header.get_data_dtype()
+    if not _fits_without_scaling(data, out_dtype):
+        nib.save(img, filename)
+        return filename
+    header.set_slope_inter(None, None)
+    header['vox_offset'] = 0
+    with open(filename, 'wb') as out_file:
+        header.write_to(out_file)
+        offset = header.get_data_offset()
+        out_file.truncate(offset + data.size * out_dtype.itemsize)
+    if data.size:
+        out_data = np.memmap(filename, dtype=out_dtype, mode='r+', offset=offset, shape=data.shape, order='F')
+        out_data[...] = data
+        out_data.flush()
+        del out_data
+    return filename
+
+def compress_nii(path):
+    # gzips path to path.gz and removes the original
+    with open(path, 'rb') as in_file, gzip.open(f"{path}.gz", 'wb', compresslevel=6) as out_file:
+        shutil.copyfileobj(in_file, out_file, length=1024*1024)
+    os.remove(path)
+    return f"{path}.gz"
+
+def compress_outputs(output_dir, exclude_dirs=['workflow_qsm']):
+    # gzips the uncompressed NIfTI files written to output_dir by the datasinks
+    compressed = []
+    for root, dirs, files in os.walk(output_dir):
+        if root == output_dir:
+            dirs[:] = [d for d in dirs if d not in exclude_dirs]
+        for f in files:
+            if f.endswith('.nii'):
+                compressed.append(compress_nii(os.path.join(root, f)))
+    return compressed
+
+def decompress_nii(path, out_path, n_threads=1):
+    # uses pigz for multithreaded decompression when available; the copy keeps the original's timestamps
+    # so that nipype's hashes are stable when the cache is rebuilt on a later run
+    tmp_path = f"{out_path}.tmp"
+    pigz = shutil.which('pigz')
+    if pigz:
+        with open(tmp_path, 'wb') as out_file:
+            subprocess.run([pigz, '-d', '-c', '-p', str(max(1, n_threads)), path], stdout=out_file, check=True)
+    else:
+        with gzip.open(path, 'rb') as in_file, open(tmp_path, 'wb') as out_file:
+            shutil.copyfileobj(in_file, out_file, length=1024*1024)
+    shutil.copystat(path, tmp_path)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+def decompress_inputs(paths, cache_dir, base_dir=None, n_threads=1):
+    # returns paths with each gzipped file replaced by an uncompressed copy in cache_dir; each input is
+    # decompressed once and reused while its modification time is unchanged
+    gz_paths = sorted(set(path for path in paths if path.endswith('.gz')))
+    if not gz_paths:
+        return list(paths)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    def get_cached_path(path):
+        # mirror the input's location (relative to base_dir if within it) so that files with the same name cannot collide
+        path = os.path.abspath(path)
+        if base_dir and os.path.commonpath([path, os.path.abspath(base_dir)]) == os.path.abspath(base_dir):
+            rel_path = os.path.relpath(path, base_dir)
+        else:
+            rel_path = os.path.splitdrive(path)[1].lstrip(os.sep)
+        return os.path.join(cache_dir, rel_path[:-len('.gz')])
+
+    def is_current(path, cached_path):
+        try:
+            return os.stat(cached_path).st_mtime_ns == os.stat(path).st_mtime_ns
+        except OSError:
+            return False
+
+    cached_paths = { path : get_cached_path(path) for path in gz_paths }
+    pending = [path for path in gz_paths if not is_current(path, cached_paths[path])]
+    for path in pending:
+        os.makedirs(os.path.dirname(cached_paths[path]), exist_ok=True)
+    if pending:
+        n_workers = max(1, min(n_threads, len(pending)))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(lambda path: decompress_nii(path, cached_paths[path], max(1, n_threads // n_workers)), pending))
+    return [cached_paths.get(path, path) for path in paths]
@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.stats import norm
+
+# threshold estimation for threshold-based masking
+# histograms use equal-width bins (so numpy can bin without sorting or searching), and large volumes can be
+# subsampled with a fixed stride so that the same input always gives the same threshold; the number of bins is
+# only bounded for subsampled volumes, so thresholds for volumes that are not subsampled are unchanged
+
+MAX_BINS = 1024
+OTSU_BINS = 256
+
+def get_samples(data, max_voxels=None):
+    # returns the voxel values as a flat float32 array, taking every n-th voxel if there are more than max_voxels
+    samples = np.ravel(data)
+    if max_voxels and samples.size > max_voxels:
+        samples = samples[::int(np.ceil(samples.size / max_voxels))]
+    return np.asarray(samples, dtype=np.float32)
+
+def get_fd_bins(samples, max_bins=None):
+    # number of bins given by the Freedman-Diaconis rule, as for bins='fd', limited to max_bins if given
+    lo, hi = float(samples.min()), float(samples.max())
+    q25, q75 = np.percentile(samples, [25, 75])
+    width = 2.0 * (q75 - q25) * samples.size ** (-1.0 / 3.0)
+    if width <= 0 or hi <= lo:
+        return 1
+    bins = max(np.ceil((hi - lo) / width), 1)
+    return int(min(bins, max_bins) if max_bins else bins)
+
+def histogram(samples, bins):
+    lo, hi = float(samples.min()), float(samples.max())
+    if hi <= lo: hi = lo + 1
+    hist, bin_edges = np.histogram(samples, bins=bins, range=(lo, hi))
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.
+    return hist, bin_centers
+
+def gaussian_threshold(data, max_voxels=None, max_bins=MAX_BINS):
+    # the bin centre where a normal fitted to the data most exceeds the normalised histogram
+    # based on doi:10.1016/j.compbiomed.2012.01.004
+    samples = get_samples(data, max_voxels)
+    subsampled = samples.size < np.size(data)
+    hist, bin_centers = histogram(samples, get_fd_bins(samples, max_bins if subsampled else None))
+    hist = hist / np.sum(hist)
+    normal_distribution = norm.pdf(bin_centers, np.mean(samples, dtype=np.float64), np.std(samples, dtype=np.float64))
+    difference = np.where(hist < normal_distribution, normal_distribution - hist, 0)
+    return float(bin_centers[np.argmax(difference)])
+
+def otsu_threshold(data, max_voxels=None, bins=OTSU_BINS):
+    # the bin centre maximising the between-class variance; as in skimage.filters.threshold_otsu
+    # based on doi:10.1109/TSMC.1979.4310076
+    samples = get_samples(data, max_voxels)
+    if samples.min() == samples.max():
+        return float(samples.min())
+    hist, bin_centers = histogram(samples, bins)
+    hist = hist.astype(np.float64)
+
+    # class probabilities and means for all possible thresholds
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    mean1 = np.cumsum(hist * bin_centers) / weight1
+    mean2 = (np.cumsum((hist * bin_centers)[::-1]) / weight2[::-1])[::-1]
+
+    # the between-class variance for thresholds at each bin centre
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return float(bin_centers[np.argmax(variance12)])
+
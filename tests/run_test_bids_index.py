@@ -0,0 +1,55 @@
+#!/usr/bin/env pytest
+import os
+import glob
+import pytest
+from scripts.bids_index import BidsIndex, load_bids_index
+
+PATTERNS = [
+    "sub*",
+    "sub*/ses*",
+    "sub*/ses*/anat/*",
+    "sub*/ses*/anat/*_run-1_*.nii*",
+    "sub*/ses*/anat/*.json",
+    "sub-1/ses-1/anat/sub-1_ses-1_T1w.nii",
+    "sub*/ses*/missing/*",
+    "*",
+]
+
+def make_bids(root):
+    for sub in ["sub-1", "sub-2"]:
+        for ses in ["ses-1", "ses-2"]:
+            anat = os.path.join(root, sub, ses, "anat")
+            os.makedirs(anat)
+            for name in [f"{sub}_{ses}_T1w.nii", f"{sub}_{ses}_run-1_echo-1_part-mag_MEGRE.nii.gz", f"{sub}_{ses}_run-1_echo-1_part-mag_MEGRE.json", ".hidden"]:
+                open(os.path.join(anat, name), 'w').close()
+    # a symlinked subject and session, and a link back up the tree
+    external = os.path.join(os.path.dirname(root), "external")
+    os.symlink(os.path.join(root, "sub-1"), os.path.join(root, "sub-3"))
+    os.symlink(os.path.join(root, "sub-2", "ses-1"), os.path.join(root, "sub-2", "ses-3"))
+    os.symlink(root, os.path.join(root, "sub-1", "ses-1", "loop"))
+    os.makedirs(os.path.join(external, "ses-1", "anat"))
+    open(os.path.join(external, "ses-1", "anat", "sub-4_ses-1_T1w.nii"), 'w').close()
+    os.symlink(external, os.path.join(root, "sub-4"))
+
+def check_globs(index, root):
+    for pattern in PATTERNS:
+        pattern = os.path.join(root, pattern)
+        assert sorted(index.glob(pattern)) == sorted(glob.glob(pattern)), pattern
+
+def test_scan_matches_glob(tmp_path):
+    root = str(tmp_path / "bids")
+    make_bids(root)
+    index = BidsIndex(root).scan()
+    check_globs(index, root)
+    assert len(index.glob(os.path.join(root, "sub*/ses*/anat/*"))) == 22
+
+def test_refresh_matches_glob(tmp_path):
+    root = str(tmp_path / "bids")
+    cache_path = str(tmp_path / "index.json")
+    make_bids(root)
+    load_bids_index(root, cache_path)
+    os.makedirs(os.path.join(root, "sub-5", "ses-1", "anat"))
+    open(os.path.join(root, "sub-5", "ses-1", "anat", "sub-5_ses-1_T1w.nii"), 'w').close()
+    os.remove(os.path.join(root, "sub-2", "ses-2", "anat", "sub-2_ses-2_T1w.nii"))
+    index = load_bids_index(root, cache_path)
+    check_globs(index, root)
@@ -0,0 +1,59 @@
+#!/usr/bin/env pytest
+import numpy as np
+import pytest
+from scipy.ndimage import binary_erosion, binary_dilation, binary_opening, binary_fill_holes, generate_binary_structure, correlate, gaussian_filter
+from scripts.mask_morphology import erode, dilate, opening, fill_holes, count_neighbours, smooth
+
+def random_mask(shape=(24, 20, 16), seed=0):
+    # blobs with holes that also touch the edges of the volume
+    rng = np.random.default_rng(seed)
+    mask = rng.random(shape) > 0.35
+    return binary_opening(mask) | (rng.random(shape) > 0.97)
+
+MASKS = {
+    'random' : random_mask(),
+    'empty' : np.zeros((8, 8, 8), dtype=bool),
+    'full' : np.ones((8, 8, 8), dtype=bool),
+    'hollow' : np.pad(np.pad(np.zeros((4, 4, 4), dtype=bool), 2, constant_values=True), 1),
+}
+
+@pytest.mark.parametrize("name", MASKS.keys())
+@pytest.mark.parametrize("iterations", [0, 1, 2, 5])
+def test_erode(name, iterations):
+    mask = MASKS[name]
+    expected = binary_erosion(mask, iterations=iterations) if iterations else mask
+    assert np.array_equal(erode(mask, iterations), expected)
+
+@pytest.mark.parametrize("name", MASKS.keys())
+@pytest.mark.parametrize("iterations", [0, 1, 2, 5])
+def test_dilate(name, iterations):
+    mask = MASKS[name]
+    expected = binary_dilation(mask, iterations=iterations) if iterations else mask
+    assert np.array_equal(dilate(mask, iterations), expected)
+
+@pytest.mark.parametrize("name", MASKS.keys())
+@pytest.mark.parametrize("iterations", [1, 3])
+def test_opening(name, iterations):
+    mask = MASKS[name]
+    assert np.array_equal(opening(mask, iterations), binary_opening(mask, iterations=iterations))
+
+@pytest.mark.parametrize("name", MASKS.keys())
+def test_fill_holes(name):
+    mask = MASKS[name]
+    assert np.array_equal(fill_holes(mask), binary_fill_holes(mask))
+
+@pytest.mark.parametrize("name", MASKS.keys())
+def test_count_neighbours(name):
+    mask = MASKS[name]
+    expected = correlate(mask.astype(int), generate_binary_structure(3, 3).astype(int), mode='constant') - mask
+    assert np.array_equal(count_neighbours(mask), expected)
+
+@pytest.mark.parametrize("truncate", [2.0, 4.0])
+@pytest.mark.parametrize("n_threads", [1, 4])
+def test_smooth(truncate, n_threads):
+    mask = random_mask((40, 36, 30), seed=1)
+    expected = gaussian_filter(mask * 1.0, [5, 5, 5], truncate=truncate)
+    smoothed = smooth(mask, [5, 5, 5], truncate=truncate, n_threads=n_threads)
+    assert smoothed.dtype == np.float32
+    assert np.max(np.abs(smoothed - expected)) <= 5e-8
+    assert np.array_equal(smoothed > 0.4, expected > 0.4)
@@ -0,0 +1,18 @@
+#!/usr/bin/env pytest
+import numpy as np
+import pytest
+from scripts.nii_fix_ge import correct_ge_complex
+
+def correct_ge_complex_fft(complex_data):
+    # the original double-precision k-space round trip
+    complex_data_kspace = np.fft.fftshift(np.fft.fftshift(np.fft.fftn(np.fft.fftshift(complex_data))), axes=2)
+    return np.fft.fftshift(np.fft.ifftn(np.fft.fftshift(complex_data_kspace)))
+
+@pytest.mark.parametrize("shape", [(16, 12, 10), (16, 12, 1), (15, 12, 10), (16, 13, 9)])
+def test_correct_ge_complex(shape):
+    rng = np.random.default_rng(0)
+    complex_data = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+    expected = correct_ge_complex_fft(complex_data.astype(np.complex128))
+    result = correct_ge_complex(complex_data.copy(), workers=1)
+    assert result.shape == expected.shape
+    assert np.max(np.abs(result - expected)) <= 1e-5 * np.max(np.abs(expected))
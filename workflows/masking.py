@@ -100,6 +100,7 @@ def masking_workflow(run_args, mask_files, magnitude_available, fill_masks, add_
 
         # do threshold masking if necessary
         if run_args.masking_algorithm == 'threshold' and not (fill_masks and run_args.filling_algorithm == 'bet'):
+            masking_threads = min(8, run_args.n_procs) if run_args.multiproc else 8
             n_threshold_masking = Node(
                 interface=masking.MaskingInterface(
                     threshold_algorithm=run_args.threshold_algorithm,
@@ -107,9 +108,12 @@ def masking_workflow(run_args, mask_files, magnitude_available, fill_masks, add_
                     fill_masks=fill_masks,
                     mask_suffix=name,
                     num_erosions=run_args.mask_erosions[index % len(run_args.mask_erosions)] if run_args.mask_erosions else 0,
-                    filling_algorithm=run_args.filling_algorithm
+                    filling_algorithm=run_args.filling_algorithm,
+                    num_threads=masking_threads,
+                    float_dtype=run_args.float_dtype
                 ),
-                name='scipy_numpy_nibabel_threshold-masking'
+                name='scipy_numpy_nibabel_threshold-masking',
+                n_procs=masking_threads
                 # inputs : ['in_files']
             )
             if run_args.threshold_value:
@@ -132,7 +136,7 @@ def masking_workflow(run_args, mask_files, magnitude_available, fill_masks, add_
                 ])
             else:
                 mn_mask_plus_bet = MapNode(
-                    interface=twopass.TwopassNiftiInterface(),
+                    interface=twopass.TwopassNiftiInterface(float_dtype=run_args.float_dtype),
                     name='numpy_nibabel_mask-plus-bet',
                     iterfield=['in_file1', 'in_file2'],
                 )
@@ -77,7 +77,7 @@ def qsm_workflow(run_args, name, magnitude_available, qsm_erosions=0):
                 ])
             else:
                 mn_romeo = Node(
-                    interface=romeo.RomeoB0Interface(),
+                    interface=romeo.RomeoB0Interface(float_dtype=run_args.float_dtype),
                     #iterfield=['phase'] + (['magnitude'] if magnitude_available else []),
                     name='mrt_romeo',
                     mem_gb=min(3, run_args.mem_avail)
@@ -104,7 +104,8 @@ def qsm_workflow(run_args, name, magnitude_available, qsm_erosions=0):
         normalize_phase_threads = min(2, run_args.n_procs) if run_args.multiproc else 2
         mn_normalize_phase = MapNode(
             interface=process_phase.PhaseToNormalizedInterface(
-                scale_factor=1e6 if run_args.qsm_algorithm == 'nextqsm' else 1e6/(2*np.pi)
+                scale_factor=1e6 if run_args.qsm_algorithm == 'nextqsm' else 1e6/(2*np.pi),
+                float_dtype=run_args.float_dtype
             ),
             name='nibabel-numpy_normalize-phase',
             iterfield=['phase', 'TE'],
@@ -130,7 +131,8 @@ def qsm_workflow(run_args, name, magnitude_available, qsm_erosions=0):
         normalize_freq_threads = min(2, run_args.n_procs) if run_args.multiproc else 2
         mn_normalize_freq = MapNode(
             interface=process_phase.FreqToNormalizedInterface(
-                scale_factor=1e6 if run_args.qsm_algorithm == 'nextqsm' else 1e6/(2*np.pi)
+                scale_factor=1e6 if run_args.qsm_algorithm == 'nextqsm' else 1e6/(2*np.pi),
+                float_dtype=run_args.float_dtype
             ),
             name='nibabel-numpy_normalize-freq',
             iterfield=['frequency'],
@@ -154,7 +156,7 @@ def qsm_workflow(run_args, name, magnitude_available, qsm_erosions=0):
     if run_args.qsm_algorithm == 'tgv' and run_args.combine_phase:
         freq_to_phase_threads = min(2, run_args.n_procs) if run_args.multiproc else 2
         mn_freq_to_phase = MapNode(
-            interface=process_phase.FreqToPhaseInterface(TE=0.005, wraps=True),
+            interface=process_phase.FreqToPhaseInterface(TE=0.005, wraps=True, float_dtype=run_args.float_dtype),
             name='nibabel-numpy_freq-to-phase',
             iterfield=['frequency'],
             mem_gb=min(3, run_args.mem_avail),
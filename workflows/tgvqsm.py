@@ -54,7 +54,7 @@ def tgvqsm_workflow(run_args, phase_file, name="tgvqsm"):
 
     # qsm averaging
     n_qsm_filled_average = Node(
-        interface=nonzeroaverage.NonzeroAverageInterface(),
+        interface=nonzeroaverage.NonzeroAverageInterface(float_dtype=run_args.float_dtype),
         name='numpy_nibabel_qsm-filled-average'
         # input : in_files
         # output : out_file
@@ -108,7 +108,7 @@ def tgvqsm_workflow(run_args, phase_file, name="tgvqsm"):
 
         # qsm averaging
         n_qsm_average = Node(
-            interface=nonzeroaverage.NonzeroAverageInterface(),
+            interface=nonzeroaverage.NonzeroAverageInterface(float_dtype=run_args.float_dtype),
             name='numpy_nibabel_qsm-average'
             # input : in_files
             # output : out_file
@@ -119,7 +119,7 @@ def tgvqsm_workflow(run_args, phase_file, name="tgvqsm"):
 
         # Two-pass combination step
         mn_qsm_twopass = MapNode(
-            interface=twopass.TwopassNiftiInterface(),
+            interface=twopass.TwopassNiftiInterface(float_dtype=run_args.float_dtype),
             name='numpy_nibabel_twopass',
             iterfield=['in_file1', 'in_file2']
         )
@@ -130,7 +130,7 @@ def tgvqsm_workflow(run_args, phase_file, name="tgvqsm"):
         ])
 
         n_qsm_twopass_average = Node(
-            interface=nonzeroaverage.NonzeroAverageInterface(),
+            interface=nonzeroaverage.NonzeroAverageInterface(float_dtype=run_args.float_dtype),
             name='numpy_nibabel_twopass-average'
             # input : in_filesoutputnode
             # output: out_file
@@ -263,7 +263,7 @@ def tgvqsm_B0_workflow(run_args, phase_file, name="tgvqsm_B0"):
 
         # Two-pass combination step
         mn_qsm_twopass = Node(
-            interface=twopass.TwopassNiftiInterface(),
+            interface=twopass.TwopassNiftiInterface(float_dtype=run_args.float_dtype),
             name='numpy_nibabel_twopass',
             iterfield=['in_file1', 'in_file2']
         )